@@ -9,10 +9,22 @@ Created on Mon Mar 23 21:37:13 2020
 from datetime import datetime
 from hashlib import md5
 import json
+import os
+import re
 import requests
+import threading
+import time
+from typing import Iterator, List
 import urllib.parse
 
-from utils import get_content_from_raw_string, bold_green, bold_red
+from board_registry import get_board_registry
+from cache import CollectionPathCache, ResponseCache
+from metrics import Metrics, default_metrics
+from parsers import BoardThread, ThreadPost, parse_board_threads, parse_thread_page
+from rate_limiter import MODERATE, POST, READ, TRANSIENT_STATUS_CODES, RequestScheduler, \
+    TransientError
+from utils import get_content_from_raw_string, iter_with_prefetch, bold_green, bold_red, \
+    bold_yellow
 
 
 class BDWM:
@@ -20,9 +32,22 @@ class BDWM:
         pass
 
     _HOST = 'bbs.pku.edu.cn'
+    # Set BDWM_BASE_URL to talk to another server, like benchmarks/mock_server.py.
+    _BASE_URL = os.environ.get('BDWM_BASE_URL', 'https://{}/v2'.format(_HOST)).rstrip('/')
     _BOARD_MODES = {'topic', 'single'}
     _BOARD_CONFIG = 'board.json'
     _COLLECTION_BASE_PATH_PATTERN = "groups/GROUP_{}/{}"
+    _TIMEOUT = 30
+    # Endpoint classes of actions for RequestScheduler, the others (login, queries and pages)
+    # are reads, which are safe to retry.
+    _ACTION_CLASSES = {
+        'ajax/create_post': POST,
+        'ajax/edit_post': POST,
+        'ajax/forward': POST,
+        'ajax/create_collection_dir': POST,
+        'ajax/collection_import': POST,
+        'ajax/operate_post': MODERATE,
+    }
     _POST_ACTION_NAME = {
         'mark': '保留',
         'unmark': '取消保留',
@@ -33,11 +58,18 @@ class BDWM:
         'highlight': '高亮',
         'unhighlight': '取消高亮',
     }
+    POST_ACTIONS = tuple(_POST_ACTION_NAME)
 
-    def __init__(self, id, passwd):
+    def __init__(self, id, passwd, pool_size: int = 10, session_store=None,
+                 collection_cache: CollectionPathCache = None, scheduler: RequestScheduler = None,
+                 response_cache: ResponseCache = None, metrics: Metrics = default_metrics):
         self._id = id
         self._passwd = passwd
         self._session = requests.session()
+        # Keep up to pool_size connections alive so that concurrent callers don't have to
+        # open a new connection for every request.
+        self._session.mount(self._BASE_URL, requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size))
         self._headers = {
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_6) '
                           'AppleWebKit/537.36 (KHTML, like Gecko) '
@@ -49,19 +81,48 @@ class BDWM:
             'Host': self._HOST,
             'X-Requested-With': 'XMLHttpRequest',
         }
-        skey, self._uid = self._login()
-        self._cookie = 'skey={}; uid={}'.format(skey, self._uid)
-        self._headers["Cookie"] = self._cookie
-        with open(self._BOARD_CONFIG) as f:
-            self._boards = json.load(f)
+        self._scheduler = scheduler or RequestScheduler()
+        self._metrics = metrics
+        # Pages are fetched from the network every time if response_cache is None.
+        self._response_cache = response_cache
+        self._session_store = session_store
+        self._collection_cache = collection_cache or CollectionPathCache()
+        self._login_lock = threading.Lock()
+        # Pages show the user id in the page head only when we are logged in, the id may also
+        # appear in the content, like the author of a post.
+        self._logged_in_pattern = re.compile(
+            r'<a\b[^>]*\bclass="username"[^>]*>\s*{}\s*</a>'.format(re.escape(id)),
+            re.IGNORECASE)
+        # A session loaded from session_store may have expired on the server, it's verified by
+        # the first successful request.
+        self._session_verified = False
+        cached_session = session_store.load(id) if session_store else None
+        if cached_session:
+            self._set_cookie(*cached_session)
+        else:
+            self._start_session()
+
+    @property
+    def id(self):
+        return self._id
+
+    def _get_board_name(self, board_name) -> str:
+        """Get the real name of a board, the board_name is case-insensitive."""
+        board_registry = get_board_registry(self._BOARD_CONFIG)
+        name = board_registry.get_name(board_name)
+        if name is None:
+            message = '没有这个版面，或暂不支持这个版面: {}'.format(board_name)
+            similar_names = board_registry.find_similar_names(board_name)
+            if similar_names:
+                message += '，你是不是要找：{}'.format('、'.join(similar_names))
+            raise ValueError(bold_red(message))
+        return name
 
     def _get_board_info(self, board_name, key) -> int:
-        if board_name not in self._boards:
-            raise ValueError(bold_red('没有这个版面，或暂不支持这个版面: {}'.format(board_name)))
-        return self._boards[board_name][key]
+        return get_board_registry(self._BOARD_CONFIG).get(self._get_board_name(board_name))[key]
 
     def _get_action_url(self, action_name, **params):
-        base_url = 'https://{}/v2/{}.php'.format(self._HOST, action_name)
+        base_url = '{}/{}.php'.format(self._BASE_URL, action_name)
         if not params:
             return base_url
         return base_url + '?' + urllib.parse.urlencode(params)
@@ -82,42 +143,181 @@ class BDWM:
         cookies_dict = self._session.cookies.get_dict()
         return cookies_dict['skey'], cookies_dict['uid']
 
+    def _set_cookie(self, skey, uid):
+        self._uid = uid
+        self._cookie = 'skey={}; uid={}'.format(skey, uid)
+        self._headers["Cookie"] = self._cookie
+
+    def _start_session(self):
+        self._headers.pop("Cookie", None)
+        skey, uid = self._login()
+        self._set_cookie(skey, uid)
+        self._session_verified = True
+        if self._session_store:
+            self._session_store.save(self._id, skey, uid)
+
+    def _restart_unverified_session(self):
+        """Login again when a request with an unverified cached session failed, as the server
+        may have rejected that session. The failed request should be sent again after this.
+        """
+        with self._login_lock:
+            # Another thread may have logged in again while we were waiting for the lock.
+            if not self._session_verified:
+                self._start_session()
+
+    def _post(self, action_name, url, data: dict = None,
+              extra_headers: dict = None) -> requests.Response:
+        """Send a request through the scheduler, transient failures of reads are retried."""
+        headers = dict(self._headers, **extra_headers) if extra_headers else self._headers
+
+        def send():
+            start_time = time.monotonic()
+            try:
+                response = self._session.post(
+                    url, headers=headers, data=data, timeout=self._TIMEOUT)
+            except requests.RequestException:
+                self._metrics.record_request(action_name, time.monotonic() - start_time, 0, True)
+                raise
+            failed = response.status_code in TRANSIENT_STATUS_CODES
+            self._metrics.record_request(
+                action_name, time.monotonic() - start_time, len(response.content), failed)
+            if failed:
+                raise TransientError(response)
+            return response
+
+        endpoint_class = self._ACTION_CLASSES.get(action_name, READ)
+        return self._scheduler.run(endpoint_class, send, idempotent=endpoint_class == READ,
+                                   on_retry=lambda error: self._metrics.record_retry(action_name))
+
     # Functions for getting page.
-    def _get_page_content(self, url):
-        return self._session.post(url, headers=self._headers).text
-    
+    def _get_page_content(self, action_name, **params):
+        url = self._get_action_url(action_name, **params)
+        response_cache = self._response_cache
+        if response_cache is None or not response_cache.is_cacheable(action_name):
+            return self._fetch_page(action_name, url).text
+
+        cached_response = response_cache.get(self._id, action_name, url)
+        if cached_response and cached_response.is_fresh:
+            return cached_response.content
+        conditional_headers = cached_response.get_conditional_headers() if cached_response else None
+        response = self._fetch_page(action_name, url, conditional_headers)
+        if response.status_code == 304 and cached_response:
+            response_cache.refresh(cached_response)
+            return cached_response.content
+        # Error pages, like a post not found or not allowed to read, are not cached.
+        if response.status_code == 200:
+            response_cache.put(self._id, action_name, url, params, response.text,
+                               response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return response.text
+
+    def _fetch_page(self, action_name, url, extra_headers: dict = None) -> requests.Response:
+        verified = self._session_verified
+        response = self._post(action_name, url, extra_headers=extra_headers)
+        if verified or response.status_code == 304:
+            return response
+        if self._logged_in_pattern.search(response.text):
+            # The cached session works, later pages without the username link, like error
+            # pages, don't need another login.
+            self._session_verified = True
+        else:
+            self._restart_unverified_session()
+            response = self._post(action_name, url, extra_headers=extra_headers)
+        return response
+
+    def _invalidate_cached_pages(self, bid, threadids=(), postids=(), all_threads=False):
+        """Drop the cached pages changed by a write action in the board with bid."""
+        if self._response_cache is None:
+            return
+        self._response_cache.invalidate('thread', bid=bid)
+        if all_threads:
+            self._response_cache.invalidate('post-read', bid=bid)
+        for threadid in threadids:
+            self._response_cache.invalidate('post-read', bid=bid, threadid=threadid)
+        for postid in postids:
+            self._response_cache.invalidate('post-read-single', bid=bid, postid=postid)
+
     def get_board_page(self, board_name, page: int = 1, mode='topic'):
         assert mode in self._BOARD_MODES, "Not a correct mode!"
-        page_url = self._get_action_url(
+        return self._get_page_content(
             'thread', bid=self._get_board_info(board_name, 'id'), mode=mode, page=page)
-        return self._get_page_content(page_url)
+
+    def iter_board_threads(self, board_name, mode='topic', since: datetime = None,
+                           first_page: int = 1, prefetch: int = 2) -> Iterator[BoardThread]:
+        """Yield the threads (or posts in single mode) of a board from first_page on, while the
+        next prefetch pages are fetched in background.
+        If since is given, stop at the first item earlier than it, pinned items are not
+        checked as they are shown on the first page however old they are.
+        """
+        assert mode in self._BOARD_MODES, "Not a correct mode!"
+        pages = iter_with_prefetch(
+            lambda page: parse_board_threads(self.get_board_page(board_name, page, mode)),
+            first_page, prefetch)
+        last_itemids = None
+        top_itemids = set()
+        try:
+            for threads in pages:
+                itemids = [thread.itemid for thread in threads]
+                # Some servers return the last page for any page number after it.
+                if not threads or itemids == last_itemids:
+                    return
+                last_itemids = itemids
+                for thread in threads:
+                    if thread.is_top:
+                        # Pinned items may be shown on every page.
+                        if thread.itemid in top_itemids:
+                            continue
+                        top_itemids.add(thread.itemid)
+                    if (since is not None and not thread.is_top and thread.time is not None
+                            and thread.time < since):
+                        return
+                    yield thread
+        finally:
+            pages.close()
 
     def get_single_post_page(self, board_name, postid: int):
-        page_url = self._get_action_url(
+        return self._get_page_content(
             'post-read-single', bid=self._get_board_info(board_name, 'id'), postid=postid)
-        return self._get_page_content(page_url)
 
-    def get_post_page(self, board_name, threadid: int):
-        page_url = self._get_action_url(
-            'post-read', bid=self._get_board_info(board_name, 'id'), threadid=threadid)
-        return self._get_page_content(page_url)
+    def get_post_page(self, board_name, threadid: int, page: int = 1):
+        return self._get_page_content(
+            'post-read', bid=self._get_board_info(board_name, 'id'), threadid=threadid,
+            page=page)
+
+    def read_thread(self, board_name, threadid: int, prefetch: int = 4) -> Iterator[ThreadPost]:
+        """Yield the posts of a thread in order, the first page tells the number of pages, then
+        the next prefetch pages are fetched in background while the posts are consumed.
+        """
+        posts, page_count = parse_thread_page(self.get_post_page(board_name, threadid))
+        yield from posts
+        pages = iter_with_prefetch(
+            lambda page: parse_thread_page(self.get_post_page(board_name, threadid, page))[0],
+            first_page=2, prefetch=prefetch, last_page=page_count)
+        try:
+            for posts in pages:
+                yield from posts
+        finally:
+            pages.close()
 
     def get_mail_page(self, postid: int):
-        page_url = self._get_action_url('mail-read', postid=postid)
-        return self._get_page_content(page_url)
+        return self._get_page_content('mail-read', postid=postid)
 
     def get_mail_content(self, page: int):
-        page_url = self._get_action_url('mail', page=page)
-        return self._get_page_content(page_url)
+        return self._get_page_content('mail', page=page)
 
     # Functions for getting action response.
+    def _post_for_data(self, relative_url, data: dict) -> dict:
+        return json.loads(self._post(relative_url, self._get_action_url(relative_url), data).text)
+
     def _get_response_data(self, relative_url, data: dict, action_string) -> dict:
-        response_data = json.loads(
-            self._session.post(self._get_action_url(relative_url), 
-                               headers=self._headers,
-                               data=data).text)
+        verified = self._session_verified
+        response_data = self._post_for_data(relative_url, data)
+        if not response_data['success'] and not verified and relative_url != 'ajax/login':
+            self._restart_unverified_session()
+            response_data = self._post_for_data(relative_url, data)
         if not response_data['success']:
+            self._metrics.record_failure(relative_url)
             raise BDWM.RequestError(bold_red(action_string + '失败！'))
+        self._session_verified = True
         return response_data
 
     @classmethod
@@ -145,6 +345,7 @@ class BDWM:
         action = '回帖' if parent_id else '发帖'
         response_data = self._get_response_data('ajax/create_post', data, action)
         postid = response_data['result']['postid']
+        self._invalidate_cached_pages(bid, threadids=[parent_id] if parent_id else [])
         post_link = self._get_action_url('post-read-single', bid=bid, postid=postid)
         print(bold_green(action + '成功！') + '帖子链接：{}'.format(post_link))
         return response_data['result']
@@ -168,6 +369,7 @@ class BDWM:
         if signature is not None:
             data['signature'] = signature
         self._get_response_data('ajax/edit_post', data, '修改帖子')
+        self._invalidate_cached_pages(bid, postids=[postid], all_threads=True)
         post_link = self._get_action_url('post-read-single', bid=bid, postid=postid)
         print(bold_green('修改帖子成功！') + '帖子链接：{}'.format(post_link))
         
@@ -182,6 +384,7 @@ class BDWM:
         self._get_response_data('ajax/forward', 
                                 data, 
                                 '转帖到{}版'.format(to_board_name))
+        self._invalidate_cached_pages(data['tobid'])
         print(bold_green('已成功转发到{}版！'.format(to_board_name)))
 
     def forward_post_to_user(self, from_board_name, postid: int, bid: int):
@@ -192,12 +395,13 @@ class BDWM:
         assert action in self._POST_ACTION_NAME, '无效的帖子操作！'
         data = {
             "bid": self._get_board_info(board_name, 'id'),
-            "list": '[{}]'.format(','.join(postid_list)),
+            "list": '[{}]'.format(','.join(str(postid) for postid in postid_list)),
             "action": action
         }
         self._get_response_data(
             'ajax/operate_post', data, 
             '{}帖子'.format(self._POST_ACTION_NAME[action]))
+        self._invalidate_cached_pages(data['bid'], postids=postid_list, all_threads=True)
         print(bold_green('{}帖子成功！'.format(self._POST_ACTION_NAME[action])))
 
     def get_post_by_num(self, board_name, internal_postid: int):
@@ -219,6 +423,7 @@ class BDWM:
         self._get_response_data('ajax/forward',
                                 data,
                                 '转发邮件到{}版'.format(to_board_name))
+        self._invalidate_cached_pages(data['tobid'])
         print(bold_green('已成功转发到{}版！'.format(to_board_name)))
 
     def forward_mail_to_user(self, postid: int, bid: int):
@@ -226,14 +431,18 @@ class BDWM:
         pass
 
     # Functions about collections.
-    def get_collection_items(self, path):
+    def list_collection_items(self, path) -> List[dict]:
+        """Get all items in the collection directory at api path, both files and directories,
+        as returned by the server, like {"title": ..., "path": ..., "isdir": ...}.
+        """
         data = {"path": path}
-        collection_items = {}
         response_data = self._get_response_data('ajax/get_collection_items', data, '获取精华区目录')
-        for directory in response_data["result"]:
-            if directory["isdir"]:
-                collection_items[directory["title"]] = directory['path']
-        return collection_items
+        return response_data["result"]
+
+    def get_collection_items(self, path):
+        """Get the sub-directories in the collection directory at api path, {title: name}."""
+        return {item["title"]: item["path"] for item in self.list_collection_items(path)
+                if item["isdir"]}
 
     def create_collection_dir(self, path, title, bms=''):
         data = {
@@ -243,6 +452,8 @@ class BDWM:
         }
         response_data = self._get_response_data('ajax/create_collection_dir', data, '创建精华区目录')
         print(bold_green('已创建精华区目录 "{}"'.format(title)))
+        self._collection_cache.add_child(path, title, response_data['name'])
+        self._collection_cache.save()
         return response_data['name']
 
     def add_new_collection(self, board_name, path, postid: int):
@@ -263,26 +474,68 @@ class BDWM:
         is "groups/GROUP_0/WMReview/D5448A5D2/D86B358DF".
         If create_if_not_exists is False, we will raise error when the directory doesn't exist,
         otherwise we will create a new one.
+        The api paths are cached, we only look up the directories after the longest cached one.
+        If that fails, the cached path may be moved or deleted on the website, so it's dropped
+        and we look up the whole path again.
         """
+        board_name = self._get_board_name(board_name)
+        parts = [dir_name for dir_name in directory_path.split('/') if dir_name]
+        cached_depth, current_api_path = 0, None
+        for depth in range(len(parts), 0, -1):
+            current_api_path = self._collection_cache.get(board_name, '/'.join(parts[:depth]))
+            if current_api_path:
+                cached_depth = depth
+                break
         section = self._get_board_info(board_name, 'section')
-        current_api_path = self._COLLECTION_BASE_PATH_PATTERN.format(section, board_name)
-        current_path = ''
-        parts = directory_path.split('/')
-        for dir_name in parts:
-            if not dir_name:
-                continue
-            if not current_path:
-                current_path = dir_name
-            else:
-                current_path = current_path + '/' + dir_name
-            collection_items = self.get_collection_items(current_api_path)
+        root_api_path = self._COLLECTION_BASE_PATH_PATTERN.format(section, board_name)
+        if not current_api_path:
+            current_api_path = root_api_path
+            self._collection_cache.put(board_name, '', current_api_path)
+
+        try:
+            current_api_path = self._look_up_collection_dir_path(
+                board_name, parts, cached_depth, current_api_path, create_if_not_exists)
+        except (BDWM.RequestError, ValueError):
+            if not cached_depth:
+                raise
+            print(bold_yellow('缓存的精华区目录【{}】已失效，重新查找'.format(
+                '/'.join(parts[:cached_depth]))))
+            self._collection_cache.invalidate(board_name, '/'.join(parts[:cached_depth]))
+            current_api_path = self._look_up_collection_dir_path(
+                board_name, parts, 0, root_api_path, create_if_not_exists)
+        finally:
+            self._collection_cache.save()
+        return current_api_path
+
+    def _look_up_collection_dir_path(self, board_name, parts, depth, api_path,
+                                     create_if_not_exists):
+        """Look up the directories in parts from depth on, api_path is the one at depth."""
+        for depth in range(depth, len(parts)):
+            dir_name = parts[depth]
+            current_path = '/'.join(parts[:depth + 1])
+            collection_items = self.get_collection_items(api_path)
             if dir_name not in collection_items:
                 if not create_if_not_exists:
                     raise ValueError(bold_red('{}版精华区不存在目录：【{}】！'.format(
                         board_name, current_path)))
-                sub_path = self.create_collection_dir(current_api_path, dir_name, bms=self._id)
+                sub_path = self.create_collection_dir(api_path, dir_name, bms=self._id)
             else:
                 sub_path = collection_items[dir_name]
-            current_api_path = current_api_path + '/' + sub_path
+            api_path = api_path + '/' + sub_path
+            self._collection_cache.put(board_name, current_path, api_path)
+        return api_path
 
-        return current_api_path
+    def invalidate_collection_cache(self, board_name, directory_path=''):
+        """Forget the cached api paths of directory_path and its sub-directories, use it after
+        the collection tree is changed outside this client.
+        """
+        self._collection_cache.invalidate(self._get_board_name(board_name), directory_path)
+        self._collection_cache.save()
+
+
+def __getattr__(name):
+    # asyncio takes long to import, so AsyncBDWM lives in its own module, loaded on first use.
+    if name == 'AsyncBDWM':
+        from async_bdwm import AsyncBDWM
+        return AsyncBDWM
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
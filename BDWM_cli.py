@@ -6,20 +6,58 @@ Created on Sat Oct 31 19:22:48 2020
 @author: KakaHiguain@BDWM
 """
 
+import contextlib
 import datetime
+import json
+import os
+import sys
 
 import click
-import dateutil.parser
 
 from BDWM import BDWM
-from utils import read_file, get_mail_postid_and_time, get_postid_list_from_internal_postids
+from batch import get_operation_board, load_jsonl_script, load_yaml_script, run_operations, \
+    validate_operations
+from board_registry import normalize_board_name
+from bulk import ImportJournal, import_collection_items, operate_posts_in_chunks
+from cache import CollectionPathCache, PostNumCache, ResponseCache
+from collection_tree import CollectionSnapshot, crawl_collection_tree
+from mail import forward_mails_to_board, get_mail_postids_within_time_range
+from metrics import default_metrics
+from pool import BDWMPool
+from rate_limiter import MODERATE, POST, READ, RequestScheduler
+from session_store import SessionStore
+from utils import read_file, get_cache_path, get_postid_list_from_internal_postids, \
+    bold_green, bold_red
 
 
 def _get_bdwm_client(id, password_file):
     password = read_file(password_file).strip('\n') if password_file else None
     if not password:
         password = click.prompt('请输入密码 (不会显示)：', hide_input=True)
-    return BDWM(id, password)
+    return _get_client_factory()(id, password)
+
+
+def _get_client_factory():
+    """Get a function creating clients with the global options, it can be called from other
+    threads, where the click context is not available.
+    """
+    options = click.get_current_context().find_root().obj or {}
+    session_store = SessionStore() if options.get('session_cache', True) else None
+    response_cache = ResponseCache() if options.get('http_cache') else None
+    # Without the file, collection paths are only cached during the command.
+    collection_cache = _get_collection_cache() if options.get('collection_cache', True) else None
+    rate_limits = options.get('rate_limits')
+
+    def create_client(id, password):
+        # Every account has its own rate limits.
+        return BDWM(id, password, session_store=session_store, collection_cache=collection_cache,
+                    scheduler=RequestScheduler(rate_limits), response_cache=response_cache)
+
+    return create_client
+
+
+def _get_collection_cache():
+    return CollectionPathCache(path=get_cache_path('collection_paths.json'))
 
 
 def _common_options(func):
@@ -33,8 +71,47 @@ def _common_options(func):
 
 
 @click.group()
-def main():
-    pass
+@click.option('--no-session-cache', is_flag=True, default=False,
+              help='Always login again instead of reusing the cached login session')
+@click.option('--no-collection-cache', is_flag=True, default=False,
+              help='Look up collection paths on the website instead of reusing the cached ones')
+@click.option('--http-cache', is_flag=True, default=False,
+              help='Reuse pages fetched recently by other commands')
+@click.option('--stats', is_flag=True, default=False,
+              help='Print the request statistics of every endpoint at the end')
+@click.option('--prometheus-file',
+              help='Write the request metrics to this file for the Prometheus textfile collector')
+@click.option('--read-rate', type=click.FloatRange(min=0.1),
+              help='Max page and query requests per second, {} by default'.format(
+                  RequestScheduler.DEFAULT_LIMITS[READ][0]))
+@click.option('--post-rate', type=click.FloatRange(min=0.1),
+              help='Max posts, edits, forwards and collection changes per second, '
+                   '{} by default'.format(RequestScheduler.DEFAULT_LIMITS[POST][0]))
+@click.option('--moderate-rate', type=click.FloatRange(min=0.1),
+              help='Max operate actions per second, {} by default'.format(
+                  RequestScheduler.DEFAULT_LIMITS[MODERATE][0]))
+@click.pass_context
+def main(ctx, no_session_cache, no_collection_cache, http_cache, stats, prometheus_file,
+         read_rate, post_rate, moderate_rate):
+    ctx.ensure_object(dict)
+    ctx.obj['session_cache'] = not no_session_cache
+    ctx.obj['collection_cache'] = not no_collection_cache
+    ctx.obj['http_cache'] = http_cache
+    # Bursts of a second of requests, but at least the default bursts.
+    default_limits = RequestScheduler.DEFAULT_LIMITS
+    ctx.obj['rate_limits'] = {
+        endpoint_class: (rate, max(int(rate), default_limits[endpoint_class][1]))
+        for endpoint_class, rate in ((READ, read_rate), (POST, post_rate),
+                                     (MODERATE, moderate_rate))
+        if rate is not None}
+
+    def report_metrics():
+        if stats:
+            click.echo(default_metrics.format_summary(), err=True)
+        if prometheus_file:
+            default_metrics.write_prometheus_textfile(prometheus_file)
+
+    ctx.call_on_close(report_metrics)
 
 
 @main.command()
@@ -78,26 +155,266 @@ def edit(id, password_file, board, postid, title, content, content_file):
 @click.option('--sort', is_flag=True, default=False, help='Sort the posts by their ids')
 @click.option('--create-if-not-exists', is_flag=True, default=False,
               help='Create a new sub-directory if the path does not exists.')
-def import_collection(
-        id, password_file, board, path, postids, internal_postids, sort, create_if_not_exists):
+@click.option('--resume', is_flag=True, default=False,
+              help='Skip the posts already imported by the previous run into the same path')
+@click.option('--journal', help='The file recording imported posts, '
+                                'a file in the cache directory by default')
+@click.option('-j', '--jobs', default=4, show_default=True,
+              help='The max number of posts imported at the same time without --sort')
+def import_collection(id, password_file, board, path, postids, internal_postids, sort,
+                      create_if_not_exists, resume, journal, jobs):
     bdwm = _get_bdwm_client(id, password_file)
     api_path = bdwm.get_collection_dir_path(board, path, create_if_not_exists)
 
     if not postids:
         if not internal_postids:
             raise ValueError('Please specify postids or internal postids')
-        postid_list = get_postid_list_from_internal_postids(bdwm, board, internal_postids)
+        postid_list = get_postid_list_from_internal_postids(
+            bdwm, board, internal_postids, cache=PostNumCache(board))
     else:
         postid_list = postids.split(',')
 
     if sort:
         postid_list.sort()
 
-    for postid in postid_list:
-        bdwm.add_new_collection(board, api_path, int(postid))
+    journal_path = journal or ImportJournal.get_default_path(board, api_path)
+    with ImportJournal(journal_path, resume=resume) as import_journal:
+        failed_postids = import_collection_items(
+            bdwm, board, api_path, postid_list, import_journal, ordered=sort, max_workers=jobs)
+    if failed_postids:
+        # The cached path may be moved or deleted on the website, look it up again next time.
+        bdwm.invalidate_collection_cache(board, path)
+        raise click.ClickException('{}个帖子未导入，可以用 --resume 重试：{}'.format(
+            len(failed_postids), ','.join(str(postid) for postid in failed_postids)))
+
+
+@main.command()
+@_common_options
+@click.option('-b', '--board', required=True, help='The board of the posts')
+@click.option('--action', required=True, type=click.Choice(BDWM.POST_ACTIONS))
+@click.option('--postids', help='The IDs of the posts you want to operate, split by ","')
+@click.option('--in-postids', 'internal_postids',
+              help='The internal IDs of the posts you want to operate, split by "," ,'
+                   'You can use ~ to represent consecutive postids.'
+                   'For example: 11233,12345~12349,12351~12352.')
+@click.option('--chunk-size', default=20, show_default=True,
+              help='The max number of posts operated in one request')
+@click.option('-j', '--jobs', default=4, show_default=True,
+              help='The max number of requests sent at the same time')
+def operate(id, password_file, board, action, postids, internal_postids, chunk_size, jobs):
+    """Mark, digest, top or highlight posts (or undo them) in bulk."""
+    bdwm = _get_bdwm_client(id, password_file)
+    if not postids:
+        if not internal_postids:
+            raise ValueError('Please specify postids or internal postids')
+        postid_list = get_postid_list_from_internal_postids(
+            bdwm, board, internal_postids, cache=PostNumCache(board))
+    else:
+        postid_list = postids.split(',')
+
+    results = operate_posts_in_chunks(
+        bdwm, board, postid_list, action, chunk_size=chunk_size, max_workers=jobs)
+    failed_chunks = [(chunk, error) for chunk, error in results if error is not None]
+    print('{}/{}组帖子操作成功'.format(len(results) - len(failed_chunks), len(results)))
+    for chunk, error in failed_chunks:
+        print(bold_red('失败：{}'.format(error)))
+        print('  重试：--postids {}'.format(','.join(str(postid) for postid in chunk)))
+    if failed_chunks:
+        raise click.ClickException('{}组帖子操作失败'.format(len(failed_chunks)))
+
+
+@main.command()
+@click.option('-b', '--board', required=True, help='The board whose collection paths are changed')
+@click.option('--path', default='',
+              help='Collection path we see on the website, the whole board by default')
+def invalidate_collection_cache(board, path):
+    """Forget the cached collection paths after the collection tree is changed elsewhere."""
+    collection_cache = _get_collection_cache()
+    # Paths are cached under the real board names.
+    collection_cache.invalidate(normalize_board_name(board), path)
+    collection_cache.save()
+
+
+@main.command()
+@_common_options
+@click.option('-b', '--board', required=True, help='The board of the collection')
+@click.option('--path', default='',
+              help='Collection path we see on the website, the whole board by default')
+@click.option('--subtree', 'subtrees', multiple=True,
+              help='Only list this directory (the path under --path) again, keeping the other '
+                   'items from the previous snapshot. Can be given many times.')
+@click.option('--snapshot', help='The snapshot file, a file in the cache directory by default')
+@click.option('-j', '--jobs', default=8, show_default=True,
+              help='The max number of directories listed at the same time')
+def mirror_collection(id, password_file, board, path, subtrees, snapshot, jobs):
+    """Save a snapshot of the collection tree, and print what changed since the last one."""
+    bdwm = _get_bdwm_client(id, password_file)
+    root_api_path = bdwm.get_collection_dir_path(board, path)
+    snapshot_path = snapshot or CollectionSnapshot.get_default_path(board, root_api_path)
+    previous = CollectionSnapshot.load(snapshot_path)
+    subtree_paths = []
+    for subtree in subtrees:
+        relative_path = previous.find_directory(subtree) if previous else None
+        if relative_path is None:
+            raise click.ClickException('上次的快照中没有这个目录：{}'.format(subtree))
+        subtree_paths.append(relative_path)
+
+    current, failed_paths = crawl_collection_tree(
+        bdwm, board, root_api_path, previous, subtree_paths, max_workers=jobs)
+    current.save(snapshot_path)
+    if previous is not None:
+        changes = current.diff(previous)
+        for mark, kind in (('+', 'added'), ('-', 'removed'), ('~', 'changed')):
+            snapshot_with_items = previous if kind == 'removed' else current
+            for relative_path in changes[kind]:
+                item = snapshot_with_items.items[relative_path]
+                print('{} {}{}'.format(mark, item['title_path'], '/' if item['isdir'] else ''))
+        print(bold_green('共{}项，新增{}项，删除{}项，修改{}项'.format(
+            len(current.items), len(changes['added']), len(changes['removed']),
+            len(changes['changed']))))
+    else:
+        print(bold_green('已保存{}版精华区的快照，共{}项'.format(board, len(current.items))))
+    if failed_paths:
+        if '' in failed_paths:
+            # The cached root may be moved or deleted on the website, look it up again next time.
+            bdwm.invalidate_collection_cache(board, path)
+        raise click.ClickException('{}个目录获取失败，保留了上次快照中的内容'.format(
+            len(failed_paths)))
+
+
+@main.command()
+@_common_options
+@click.option('-b', '--board', required=True, help='The board you want to archive')
+@click.option('--mode', type=click.Choice(['topic', 'single']), default='topic', show_default=True)
+@click.option('--db', help='The archive database, a file in the cache directory by default')
+@click.option('--with-content', is_flag=True, default=False,
+              help='Also archive the posts of the threads in topic mode, which takes requests '
+                   'for every new or replied thread')
+@click.option('-j', '--jobs', default=4, show_default=True,
+              help='The max number of threads read at the same time with --with-content')
+def archive(id, password_file, board, mode, db, with_content, jobs):
+    """Save the threads of a board newer than the last run into the local archive.
+
+    Only the titles, authors and counts of threads are saved, unless --with-content is given.
+    Once a thread is archived with --with-content, its posts are fetched again by later runs
+    whenever it gets new replies.
+    """
+    if with_content and mode != 'topic':
+        raise click.UsageError('--with-content only works in topic mode')
+    from archive import BoardArchive
+    bdwm = _get_bdwm_client(id, password_file)
+    with BoardArchive(db) as board_archive:
+        count = board_archive.sync(bdwm, board, mode=mode, with_content=with_content)
+        print(bold_green('已归档{}版的{}个帖子'.format(board, count)))
+        if with_content:
+            post_count, failed_threadids = board_archive.sync_content(
+                bdwm, board, max_workers=jobs)
+            print(bold_green('已归档{}条回复'.format(post_count)))
+            if failed_threadids:
+                raise click.ClickException('{}个帖子获取失败，下次归档时重试'.format(
+                    len(failed_threadids)))
+
+
+@main.command()
+@click.argument('query')
+@click.option('-b', '--board', help='Only search in this board')
+@click.option('--limit', default=50, show_default=True)
+@click.option('--db', help='The archive database, a file in the cache directory by default')
+def search(query, board, limit, db):
+    """Search the titles and authors of archived threads, and the posts archived with
+    archive --with-content, without touching the network.
+    """
+    from archive import BoardArchive
+    with BoardArchive(db) as board_archive:
+        for row in board_archive.search(query, board_name=board, limit=limit):
+            print('{}  {:<12} {:<12} {}  {}'.format(
+                row['time'] or '', row['board'], row['author'], row['itemid'], row['title']))
+
+
+@main.command()
+@click.option('--id', help='北大未名用户名, not needed with --accounts')
+@click.option('-pf', '--password-file', help='The file containing your password')
+@click.option('--accounts', help='A JSON file of accounts, every operation is run by an '
+                                 'account allowed on its board, see pool.py')
+@click.argument('script', type=click.File('r'), default='-')
+@click.option('--format', 'script_format', type=click.Choice(['auto', 'jsonl', 'yaml']),
+              default='auto', show_default=True,
+              help='The script format, auto means YAML for .yaml/.yml files and JSONL otherwise')
+@click.option('-o', '--output', default='-',
+              help='The file receiving the result of every operation as JSON lines')
+@click.option('-j', '--jobs', default=4, show_default=True,
+              help='The max number of parallel operations run at the same time')
+@click.option('--keep-going', is_flag=True, default=False,
+              help='Run the rest of the script after an operation fails')
+@click.option('--check', is_flag=True, default=False,
+              help='Only check the script without running it')
+def batch(id, password_file, accounts, script, script_format, output, jobs, keep_going, check):
+    """Run a script of post, edit, forward, import and operate operations with one login, or
+    one login per account with --accounts, where edit and mail forwarding operations need an
+    "account" to run with.
+
+    SCRIPT is a JSONL or YAML file, or - for stdin. See batch.py for the format.
+    """
+    if not id and not accounts:
+        raise click.UsageError('Please specify --id or --accounts')
+    if script_format == 'auto':
+        is_yaml = os.path.splitext(script.name)[1].lower() in ('.yaml', '.yml')
+        script_format = 'yaml' if is_yaml else 'jsonl'
+    text = script.read()
+    try:
+        operations = (load_yaml_script if script_format == 'yaml' else load_jsonl_script)(text)
+        if accounts:
+            bdwm = BDWMPool.from_config(accounts, client_factory=_get_client_factory())
+            validate_operations(operations, account_ids=bdwm.ids, require_account=True)
+            for operation in operations:
+                if not operation.get('account'):
+                    bdwm.get_accounts_for_board(get_operation_board(operation))
+        else:
+            validate_operations(operations, account_ids=[id])
+    except (ValueError, OSError) as e:
+        raise click.ClickException(str(e))
+    if check:
+        print(bold_green('脚本中的{}个操作检查无误'.format(len(operations))))
+        return
+
+    with contextlib.ExitStack() as stack:
+        if accounts:
+            stack.enter_context(bdwm)
+        else:
+            bdwm = _get_bdwm_client(id, password_file)
+        if output == '-':
+            result_file = sys.stdout
+            # Keep stdout for the results, the messages of the client go to stderr.
+            stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+        else:
+            result_file = stack.enter_context(open(output, 'w'))
+        failures = run_operations(bdwm, operations, result_file, max_workers=jobs,
+                                  keep_going=keep_going)
+    if failures:
+        raise click.ClickException('{}个操作失败'.format(failures))
+
+
+@main.command()
+@_common_options
+@click.option('-b', '--board', required=True, help='The board of the thread')
+@click.option('--threadid', required=True, type=int, help='The ID of the thread')
+@click.option('-o', '--output', type=click.File('w'), default='-',
+              help='The file receiving the posts as JSON lines, stdout by default')
+@click.option('-j', '--jobs', 'prefetch', default=4, show_default=True,
+              help='The max number of pages fetched at the same time')
+def export_thread(id, password_file, board, threadid, output, prefetch):
+    """Export all posts of a thread with their author, time, floor and content."""
+    bdwm = _get_bdwm_client(id, password_file)
+    count = 0
+    for post in bdwm.read_thread(board, threadid, prefetch=prefetch):
+        output.write(json.dumps(post.to_dict(), ensure_ascii=False) + '\n')
+        count += 1
+    click.echo(bold_green('已导出{}个帖子'.format(count)), err=True)
 
 
 def _parse_datetime(ctx, param, value) -> datetime.datetime:
+    # dateutil takes long to import, only load it for the commands taking times.
+    import dateutil.parser
     return dateutil.parser.parse(value)
 
 
@@ -108,31 +425,35 @@ def _parse_datetime(ctx, param, value) -> datetime.datetime:
 @click.option('--end', required=True, callback=_parse_datetime, prompt='结束时间, MM/DD HH:MM')
 @click.option('--start-post', default='', prompt='转发前发的帖')
 @click.option('--end-post', default='', prompt='转发后发的帖')
-def forward_mail_within_time_range(id, password_file, board, start, end, start_post, end_post):
+@click.option('--no-mail-index', is_flag=True, default=False,
+              help='Search the mailbox online instead of using the local mail index')
+@click.option('--rebuild-mail-index', is_flag=True, default=False,
+              help='Build the local mail index again, use it after mails are deleted')
+def forward_mail_within_time_range(id, password_file, board, start, end, start_post, end_post,
+                                   no_mail_index, rebuild_mail_index):
     if start > end:
         raise ValueError('Start time can not later than end time!')
     bdwm = _get_bdwm_client(id, password_file)
-    # 2020-08-06 16:05:31
-    page = 1
-    finished = False
-    postids = []
-    while not finished:
-        mails = get_mail_postid_and_time(bdwm.get_mail_content(page=page))
-        for mail in mails:
-            if mail[1] < start:
-                finished = True
-                break
-            if mail[1] > end:
-                continue
-            postids.append(mail[0])
-        page += 1
-
-    if start_post:
-        bdwm.create_post(board, start_post)
-    for postid in reversed(postids):
-        bdwm.forward_mail_to_board(board, postid)
+    with contextlib.ExitStack() as stack:
+        if no_mail_index:
+            mail_index = None
+            postids = get_mail_postids_within_time_range(bdwm, start, end)
+        else:
+            from mail_index import MailIndex, get_indexed_mail_postids_within_time_range
+            mail_index = stack.enter_context(MailIndex())
+            if rebuild_mail_index:
+                mail_index.clear(bdwm.id)
+            postids = get_indexed_mail_postids_within_time_range(bdwm, start, end, mail_index)
+
+        if start_post:
+            bdwm.create_post(board, start_post)
+        # A mail failed to forward is skipped, so that the run still ends with end_post.
+        failed_postids = forward_mails_to_board(bdwm, board, list(reversed(postids)), mail_index)
     if end_post:
         bdwm.create_post(board, end_post)
+    if failed_postids:
+        raise click.ClickException('{}封邮件转发失败：{}'.format(
+            len(failed_postids), ','.join(str(postid) for postid in failed_postids)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local archive of board threads in SQLite, searchable without touching the network.
+
+Threads are saved from the board pages, with their titles, authors and counts. The posts of
+topic mode threads are saved only when asked, as every thread takes requests of its own. A post
+is saved as plain text without its font codes.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import re
+import sqlite3
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+import requests
+
+from BDWM import BDWM
+from board_registry import normalize_board_name
+from parsers import BoardThread, ThreadPost
+from utils import get_cache_path, bold_red
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS threads (
+    board TEXT NOT NULL,
+    itemid INTEGER NOT NULL,
+    num INTEGER,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    time TEXT,
+    reply_count INTEGER NOT NULL,
+    flags TEXT NOT NULL,
+    PRIMARY KEY (board, itemid)
+);
+CREATE INDEX IF NOT EXISTS threads_board_time ON threads (board, time);
+CREATE TABLE IF NOT EXISTS sync_state (
+    board TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    high_water_time TEXT,
+    synced_at TEXT NOT NULL,
+    PRIMARY KEY (board, mode)
+);
+CREATE TABLE IF NOT EXISTS posts (
+    board TEXT NOT NULL,
+    threadid INTEGER NOT NULL,
+    postid INTEGER NOT NULL,
+    floor INTEGER,
+    author TEXT NOT NULL,
+    time TEXT,
+    content TEXT NOT NULL,
+    PRIMARY KEY (board, postid)
+);
+CREATE INDEX IF NOT EXISTS posts_board_thread ON posts (board, threadid);
+-- Threads whose posts are archived, with their reply counts when the posts were saved, NULL if
+-- the posts are not saved yet. The posts are fetched again when the reply count changes.
+CREATE TABLE IF NOT EXISTS content_state (
+    board TEXT NOT NULL,
+    threadid INTEGER NOT NULL,
+    reply_count INTEGER,
+    PRIMARY KEY (board, threadid)
+);
+'''
+
+# The trigram tokenizer also works for Chinese, which has no spaces between words.
+_FTS_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS threads_fts USING fts5(
+    title, author, content='threads', content_rowid='rowid', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS threads_fts_insert AFTER INSERT ON threads BEGIN
+    INSERT INTO threads_fts (rowid, title, author) VALUES (new.rowid, new.title, new.author);
+END;
+CREATE TRIGGER IF NOT EXISTS threads_fts_delete AFTER DELETE ON threads BEGIN
+    INSERT INTO threads_fts (threads_fts, rowid, title, author)
+    VALUES ('delete', old.rowid, old.title, old.author);
+END;
+CREATE TRIGGER IF NOT EXISTS threads_fts_update AFTER UPDATE ON threads BEGIN
+    INSERT INTO threads_fts (threads_fts, rowid, title, author)
+    VALUES ('delete', old.rowid, old.title, old.author);
+    INSERT INTO threads_fts (rowid, title, author) VALUES (new.rowid, new.title, new.author);
+END;
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+    content, content='posts', content_rowid='rowid', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+    INSERT INTO posts_fts (rowid, content) VALUES (new.rowid, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+    INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+END;
+CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE ON posts BEGIN
+    INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+    INSERT INTO posts_fts (rowid, content) VALUES (new.rowid, new.content);
+END;
+'''
+# Trigram queries need at least 3 characters in every term.
+_FTS_MIN_TERM_LENGTH = 3
+
+_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_ANSI_SEQUENCE_PATTERN = re.compile(r'\x1b\[[0-9;]*m?')
+
+
+def _format_time(time: Optional[datetime.datetime]):
+    return time.strftime(_TIME_FORMAT) if time else None
+
+
+def _escape_like_pattern(term):
+    return '%{}%'.format(term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+
+
+class BoardArchive:
+    def __init__(self, path=None):
+        self._connection = sqlite3.connect(
+            path or get_cache_path('archive.sqlite3'), check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._connection:
+            self._connection.executescript(_SCHEMA)
+            try:
+                self._connection.executescript(_FTS_SCHEMA)
+                self._has_fts = True
+            except sqlite3.OperationalError:
+                # SQLite before 3.34 doesn't have the trigram tokenizer, search with LIKE.
+                self._has_fts = False
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_high_water_time(self, board_name, mode) -> Optional[datetime.datetime]:
+        row = self._connection.execute(
+            'SELECT high_water_time FROM sync_state WHERE board = ? AND mode = ?',
+            (normalize_board_name(board_name), mode)).fetchone()
+        if not row or not row['high_water_time']:
+            return None
+        return datetime.datetime.strptime(row['high_water_time'], _TIME_FORMAT)
+
+    def save_threads(self, board_name, threads: Iterable[BoardThread]):
+        board_name = normalize_board_name(board_name)
+        rows = [(board_name, thread.itemid, thread.num, thread.title, thread.author,
+                 thread.time.strftime(_TIME_FORMAT) if thread.time else None,
+                 thread.reply_count, ','.join(sorted(thread.flags)))
+                for thread in threads]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT INTO threads (board, itemid, num, title, author, time, reply_count, flags)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+                ' ON CONFLICT (board, itemid) DO UPDATE SET num = excluded.num,'
+                ' title = excluded.title, author = excluded.author, time = excluded.time,'
+                ' reply_count = excluded.reply_count, flags = excluded.flags', rows)
+
+    def save_posts(self, board_name, threadid, reply_count, posts: Iterable[ThreadPost]):
+        """Replace the saved posts of a thread, and record the reply count they are saved at."""
+        board_name = normalize_board_name(board_name)
+        rows = [(board_name, threadid, post.postid, post.floor, post.author,
+                 _format_time(post.time), _ANSI_SEQUENCE_PATTERN.sub('', post.content))
+                for post in posts]
+        with self._lock, self._connection:
+            # Deleted posts are gone from the thread pages, so they are removed here too.
+            self._connection.execute('DELETE FROM posts WHERE board = ? AND threadid = ?',
+                                     (board_name, threadid))
+            self._connection.executemany(
+                'INSERT INTO posts (board, threadid, postid, floor, author, time, content)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)'
+                ' ON CONFLICT (board, postid) DO UPDATE SET threadid = excluded.threadid,'
+                ' floor = excluded.floor, author = excluded.author, time = excluded.time,'
+                ' content = excluded.content', rows)
+            self._connection.execute(
+                'INSERT OR REPLACE INTO content_state (board, threadid, reply_count)'
+                ' VALUES (?, ?, ?)', (board_name, threadid, reply_count))
+
+    def _add_content_threads(self, board_name, threads: Iterable[BoardThread]):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO content_state (board, threadid, reply_count)'
+                ' VALUES (?, ?, NULL)', [(board_name, thread.itemid) for thread in threads])
+
+    def get_outdated_content_threads(self, board_name) -> List[Tuple[int, int]]:
+        """Get the (threadid, reply_count) of the threads whose posts are archived but not
+        saved yet, or saved before the thread got new replies.
+        """
+        rows = self._connection.execute(
+            'SELECT threads.itemid, threads.reply_count FROM content_state'
+            ' JOIN threads ON threads.board = content_state.board'
+            ' AND threads.itemid = content_state.threadid'
+            ' WHERE content_state.board = ? AND (content_state.reply_count IS NULL'
+            ' OR content_state.reply_count != threads.reply_count)'
+            ' ORDER BY threads.time DESC', (normalize_board_name(board_name),)).fetchall()
+        return [(row['itemid'], row['reply_count']) for row in rows]
+
+    def sync_content(self, bdwm, board_name, max_workers=4) -> Tuple[int, List[int]]:
+        """Save the posts of the outdated threads (see get_outdated_content_threads), reading
+        up to max_workers threads at the same time. A thread failed to read is tried again by
+        the next sync.
+        Return the number of posts saved and the threadids failed to read.
+        """
+        board_name = normalize_board_name(board_name)
+
+        def read_thread(threadid):
+            return list(bdwm.read_thread(board_name, threadid))
+
+        count = 0
+        failed_threadids = []
+        outdated_threads = self.get_outdated_content_threads(board_name)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(threadid, reply_count, executor.submit(read_thread, threadid))
+                       for threadid, reply_count in outdated_threads]
+            for threadid, reply_count, future in futures:
+                try:
+                    posts = future.result()
+                except (BDWM.RequestError, requests.RequestException, ValueError) as e:
+                    print(bold_red('获取帖子{}失败：{}'.format(threadid, e)))
+                    failed_threadids.append(threadid)
+                    continue
+                self.save_posts(board_name, threadid, reply_count, posts)
+                count += len(posts)
+        return count, failed_threadids
+
+    def _save_synced_threads(self, board_name, threads: List[BoardThread], with_content):
+        self.save_threads(board_name, threads)
+        if with_content:
+            self._add_content_threads(board_name, threads)
+
+    def sync(self, bdwm, board_name, mode='topic', batch_size=200, with_content=False) -> int:
+        """Fetch the board pages newer than the last sync and save their threads. With
+        with_content in topic mode, the posts of these threads are archived from now on, and
+        saved by sync_content.
+        Return the number of threads saved.
+        """
+        assert not with_content or mode == 'topic', 'Posts are only archived in topic mode!'
+        # Boards are saved under their real names, whatever case they are typed in.
+        board_name = normalize_board_name(board_name)
+        now = datetime.datetime.now()
+        since = self.get_high_water_time(board_name, mode)
+        if since is not None and since > now:
+            # A mark in the future hides every new thread, it's dropped and the board is synced
+            # again from the start.
+            since = None
+        high_water_time = since
+        count = 0
+        batch = []
+        for thread in bdwm.iter_board_threads(board_name, mode=mode, since=since):
+            batch.append(thread)
+            # Times in the future, like a misparsed date, never become the mark.
+            if thread.time and not thread.is_top and thread.time <= now and (
+                    high_water_time is None or thread.time > high_water_time):
+                high_water_time = thread.time
+            if len(batch) >= batch_size:
+                self._save_synced_threads(board_name, batch, with_content)
+                count += len(batch)
+                batch = []
+        self._save_synced_threads(board_name, batch, with_content)
+        count += len(batch)
+
+        # The high-water mark is saved only after the whole sync, so an interrupted sync is
+        # done again from the previous mark.
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO sync_state (board, mode, high_water_time, synced_at)'
+                ' VALUES (?, ?, ?, ?)',
+                (board_name, mode,
+                 high_water_time.strftime(_TIME_FORMAT) if high_water_time else None,
+                 datetime.datetime.now().strftime(_TIME_FORMAT)))
+        return count
+
+    def _get_match_condition(self, table, columns, terms) -> Tuple[str, list]:
+        """Get the condition of the rows in table whose columns contain all the terms."""
+        if self._has_fts and all(len(term) >= _FTS_MIN_TERM_LENGTH for term in terms):
+            return ('{0}.rowid IN (SELECT rowid FROM {0}_fts WHERE {0}_fts MATCH ?)'.format(table),
+                    [' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)])
+        conditions, params = [], []
+        for term in terms:
+            conditions.append('({})'.format(' OR '.join(
+                "{}.{} LIKE ? ESCAPE '\\'".format(table, column) for column in columns)))
+            params.extend([_escape_like_pattern(term)] * len(columns))
+        return ' AND '.join(conditions), params
+
+    def search(self, query, board_name=None, limit=50) -> List[sqlite3.Row]:
+        """Search the threads whose title or author, or one of whose archived posts, contains
+        all the words in query.
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        thread_condition, params = self._get_match_condition('threads', ('title', 'author'), terms)
+        post_condition, post_params = self._get_match_condition('posts', ('content',), terms)
+        conditions = ['({} OR EXISTS (SELECT 1 FROM posts WHERE posts.board = threads.board'
+                      ' AND posts.threadid = threads.itemid AND {}))'.format(
+                          thread_condition, post_condition)]
+        params += post_params
+        if board_name:
+            conditions.append('board = ?')
+            params.append(normalize_board_name(board_name))
+        params.append(limit)
+        return self._connection.execute(
+            'SELECT * FROM threads WHERE {} ORDER BY time DESC LIMIT ?'.format(
+                ' AND '.join(conditions)), params).fetchall()
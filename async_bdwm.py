@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The asyncio client, kept apart from BDWM.py so that importing BDWM doesn't load asyncio.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import inspect
+
+from BDWM import BDWM
+
+
+class AsyncBDWM:
+    """The asyncio counterpart of BDWM.
+
+    All public methods of BDWM are exposed as coroutines with the same arguments, except the
+    generator methods like read_thread, which are async iterators used with "async for". They
+    run on a wrapped BDWM client, so login, headers and cookies are shared with the sync client,
+    and at most max_in_flight requests are sent at the same time over its pooled connections.
+    """
+    RequestError = BDWM.RequestError
+    _DEFAULT_MAX_IN_FLIGHT = 8
+
+    def __init__(self, id, passwd, max_in_flight: int = _DEFAULT_MAX_IN_FLIGHT):
+        self._setup(BDWM(id, passwd, pool_size=max_in_flight), max_in_flight)
+
+    @classmethod
+    def from_client(cls, client: BDWM, max_in_flight: int = _DEFAULT_MAX_IN_FLIGHT):
+        """Wrap an already logged-in BDWM client."""
+        async_client = cls.__new__(cls)
+        async_client._setup(client, max_in_flight)
+        return async_client
+
+    def _setup(self, client, max_in_flight):
+        assert max_in_flight > 0, 'max_in_flight should be positive!'
+        self._client = client
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        # Sync generators behind the async iterators not finished yet, closed by close().
+        self._open_iterators = set()
+        self._closed = False
+
+    @property
+    def client(self) -> BDWM:
+        return self._client
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    def _close_iterator(self, iterator):
+        self._open_iterators.discard(iterator)
+        try:
+            iterator.close()
+        except ValueError:
+            # It's still running in the executor, which stops it after the current item.
+            pass
+
+    def close(self):
+        """Stop the async iterators left by their callers, and wait for the running requests."""
+        self._closed = True
+        for iterator in list(self._open_iterators):
+            self._close_iterator(iterator)
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # Waiting for the running requests would block the event loop.
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+
+def _make_async_method(name):
+    sync_method = getattr(BDWM, name)
+
+    async def async_method(self, *args, **kwargs):
+        return await self._run(getattr(self._client, name), *args, **kwargs)
+
+    async_method.__name__ = name
+    async_method.__qualname__ = 'AsyncBDWM.' + name
+    async_method.__doc__ = sync_method.__doc__
+    return async_method
+
+
+_EXHAUSTED = object()
+
+
+def _make_async_generator_method(name):
+    sync_method = getattr(BDWM, name)
+
+    async def async_generator_method(self, *args, **kwargs):
+        iterator = getattr(self._client, name)(*args, **kwargs)
+        self._open_iterators.add(iterator)
+        try:
+            while True:
+                # Every item is taken in the executor, as it may fetch a page.
+                item = await self._run(next, iterator, _EXHAUSTED)
+                if item is _EXHAUSTED:
+                    return
+                yield item
+        finally:
+            # Stop the prefetching of the generator if the caller stops early. An async
+            # iterator left by a "break" is only finalized later, maybe after close().
+            if self._closed:
+                self._close_iterator(iterator)
+            else:
+                self._open_iterators.discard(iterator)
+                await self._run(iterator.close)
+
+    async_generator_method.__name__ = name
+    async_generator_method.__qualname__ = 'AsyncBDWM.' + name
+    async_generator_method.__doc__ = sync_method.__doc__
+    return async_generator_method
+
+
+for _name, _member in list(vars(BDWM).items()):
+    if not _name.startswith('_') and callable(_member) and not isinstance(_member, type):
+        if inspect.isgeneratorfunction(_member):
+            setattr(AsyncBDWM, _name, _make_async_generator_method(_name))
+        else:
+            setattr(AsyncBDWM, _name, _make_async_method(_name))
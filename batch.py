@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run a script of operations through one BDWM client.
+
+A script is a list of operations, as JSON objects one per line (blank lines and lines starting
+with "#" are skipped), or as a YAML list. Every operation has an "op" and the options of the
+CLI command with the same name, for example:
+
+    {"op": "post", "board": "Test", "title": "Weekly digest", "content_file": "header.txt"}
+    {"op": "forward", "to_board": "Test", "start": "2020-11-01", "end": "2020-11-08"}
+    {"op": "import", "board": "WMReview", "path": "历期起居注/2020年11月",
+     "in_postids": "1~20"}
+    {"op": "operate", "board": "Test", "action": "mark", "postids": [1, 2], "parallel": true}
+    {"op": "edit", "board": "Test", "postid": 123, "title": "Title", "content": "...",
+     "parallel": true}
+
+Consecutive operations with "parallel": true run at the same time, all others one by one.
+With several accounts, "account" chooses the account running an operation, which is required
+for edit and for forwarding mails.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+from typing import List
+
+import requests
+
+from BDWM import BDWM
+from bulk import ImportJournal, import_collection_items, operate_posts_in_chunks
+from cache import PostNumCache
+from mail import forward_mails_to_board, get_mail_postids_within_time_range
+from pool import BDWMPool
+from utils import get_postid_list_from_internal_postids, read_file, bold_red
+
+
+class OperationFailed(RuntimeError):
+    """Some of the posts in an operation failed, the others may be done."""
+
+
+def load_jsonl_script(text) -> List[dict]:
+    operations = []
+    for line_number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            operations.append(json.loads(line))
+        except ValueError as e:
+            raise ValueError('Invalid JSON at line {}: {}'.format(line_number, e))
+    return operations
+
+
+def load_yaml_script(text) -> List[dict]:
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError('Please install PyYAML to run YAML scripts: pip install pyyaml')
+    operations = yaml.safe_load(text) or []
+    if not isinstance(operations, list):
+        raise ValueError('A YAML script should be a list of operations')
+    return operations
+
+
+def _get_content(operation):
+    if operation.get('content'):
+        return operation['content']
+    return read_file(operation['content_file']) if operation.get('content_file') else ''
+
+
+def _get_postid_list(bdwm: BDWM, operation) -> List:
+    board = operation['board']
+    postids = operation.get('postids')
+    if postids:
+        return postids.split(',') if isinstance(postids, str) else list(postids)
+    return get_postid_list_from_internal_postids(
+        bdwm, board, operation['in_postids'], cache=PostNumCache(board))
+
+
+def _parse_datetime(value):
+    # dateutil takes long to import, only load it for the scripts forwarding mails.
+    import dateutil.parser
+    return dateutil.parser.parse(str(value))
+
+
+def _run_post(bdwm: BDWM, operation):
+    return bdwm.create_post(operation['board'], operation['title'], _get_content(operation),
+                            no_reply=operation.get('no_reply', False),
+                            parent_id=operation.get('parent_id'))
+
+
+def _run_edit(bdwm: BDWM, operation):
+    bdwm.edit_post(operation['board'], operation['postid'], operation['title'],
+                   _get_content(operation))
+    return {'postid': operation['postid']}
+
+
+def _run_forward(bdwm: BDWM, operation):
+    to_board = operation['to_board']
+    if 'mail_postid' in operation:
+        bdwm.forward_mail_to_board(to_board, operation['mail_postid'])
+        return {'forwarded': 1}
+    if 'postid' in operation:
+        bdwm.forward_post(operation['board'], to_board, operation['postid'])
+        return {'forwarded': 1}
+
+    start, end = _parse_datetime(operation['start']), _parse_datetime(operation['end'])
+    if start > end:
+        raise ValueError('Start time can not later than end time!')
+    # Forward the oldest mail first, like forward-mail-within-time-range.
+    if operation.get('mail_index', True):
+        from mail_index import MailIndex, get_indexed_mail_postids_within_time_range
+        with MailIndex() as mail_index:
+            postids = get_indexed_mail_postids_within_time_range(bdwm, start, end, mail_index)
+            failed_postids = forward_mails_to_board(
+                bdwm, to_board, list(reversed(postids)), mail_index)
+    else:
+        postids = get_mail_postids_within_time_range(bdwm, start, end)
+        failed_postids = forward_mails_to_board(bdwm, to_board, list(reversed(postids)))
+    if failed_postids:
+        raise OperationFailed('{}封邮件转发失败：{}'.format(
+            len(failed_postids), ','.join(str(postid) for postid in failed_postids)))
+    return {'forwarded': len(postids)}
+
+
+def _run_import(bdwm: BDWM, operation):
+    board = operation['board']
+    api_path = bdwm.get_collection_dir_path(
+        board, operation['path'], operation.get('create_if_not_exists', False))
+    postid_list = _get_postid_list(bdwm, operation)
+    ordered = operation.get('sort', False)
+    if ordered:
+        postid_list.sort()
+
+    journal_path = operation.get('journal') or ImportJournal.get_default_path(board, api_path)
+    with ImportJournal(journal_path, resume=operation.get('resume', False)) as journal:
+        failed_postids = import_collection_items(
+            bdwm, board, api_path, postid_list, journal, ordered=ordered,
+            max_workers=operation.get('jobs', 4))
+    if failed_postids:
+        # The cached path may be moved or deleted on the website, look it up again next time.
+        bdwm.invalidate_collection_cache(board, operation['path'])
+        raise OperationFailed('{}个帖子未导入，加上"resume": true重试：{}'.format(
+            len(failed_postids), ','.join(str(postid) for postid in failed_postids)))
+    return {'api_path': api_path, 'count': len(postid_list)}
+
+
+def _run_operate(bdwm: BDWM, operation):
+    postid_list = _get_postid_list(bdwm, operation)
+    results = operate_posts_in_chunks(
+        bdwm, operation['board'], postid_list, operation['action'],
+        chunk_size=operation.get('chunk_size', 20), max_workers=operation.get('jobs', 4))
+    failed_postids = [postid for chunk, error in results if error is not None for postid in chunk]
+    if failed_postids:
+        raise OperationFailed('{}个帖子操作失败：{}'.format(
+            len(failed_postids), ','.join(str(postid) for postid in failed_postids)))
+    return {'count': len(postid_list)}
+
+
+# {op: (function running it, required fields, groups of fields one of which is required)}
+_OPERATIONS = {
+    'post': (_run_post, ('board', 'title'), ()),
+    'edit': (_run_edit, ('board', 'postid', 'title'), ()),
+    'forward': (_run_forward, ('to_board',),
+                (('mail_postid', 'postid', 'start'),)),
+    'import': (_run_import, ('board', 'path'), (('postids', 'in_postids'),)),
+    'operate': (_run_operate, ('board', 'action'), (('postids', 'in_postids'),)),
+}
+
+
+def is_account_bound(operation) -> bool:
+    """Whether the result depends on whose account runs the operation: forwarding mails reads
+    the mailbox of the account, and only the author can edit a post.
+    """
+    return operation['op'] == 'edit' or (
+        operation['op'] == 'forward' and 'postid' not in operation)
+
+
+def validate_operations(operations: List[dict], account_ids: List[str] = None,
+                        require_account=False):
+    """Check the whole script before running anything, so that a typo in the last operation
+    doesn't leave the script half done.
+    The "account" of every operation should be in account_ids if it's given. With
+    require_account, which is needed for several accounts, the operations bound to an
+    account must have one.
+    """
+    known_accounts = {account_id.lower() for account_id in account_ids or []}
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in _OPERATIONS:
+            raise ValueError('Operation {}: "op" should be one of {}'.format(
+                index, ', '.join(_OPERATIONS)))
+        _, required_fields, field_groups = _OPERATIONS[operation['op']]
+        required_fields = list(required_fields)
+        if operation['op'] == 'forward' and 'postid' in operation:
+            required_fields.append('board')
+        if operation['op'] == 'forward' and 'start' in operation:
+            required_fields.append('end')
+        missing_fields = [field for field in required_fields if field not in operation]
+        missing_fields += ['/'.join(group) for group in field_groups
+                           if not any(field in operation for field in group)]
+        if missing_fields:
+            raise ValueError('Operation {} ({}): missing {}'.format(
+                index, operation['op'], ', '.join(missing_fields)))
+        if operation['op'] == 'operate' and operation['action'] not in BDWM.POST_ACTIONS:
+            raise ValueError('Operation {}: invalid action {}'.format(index, operation['action']))
+        account = operation.get('account')
+        if account is not None and account_ids is not None \
+                and str(account).lower() not in known_accounts:
+            raise ValueError('Operation {}: unknown account {}'.format(index, account))
+        if require_account and account is None and is_account_bound(operation):
+            raise ValueError('Operation {} ({}): "account" is needed to choose whose {} '
+                             'it is'.format(index, operation['op'],
+                                            'post' if operation['op'] == 'edit' else 'mailbox'))
+
+
+def get_operation_board(operation):
+    """The board an account needs permission on to run the operation."""
+    return operation['to_board'] if operation['op'] == 'forward' else operation['board']
+
+
+# Errors failing a single operation, the others still run.
+_OPERATION_ERRORS = (BDWM.RequestError, OperationFailed, requests.RequestException, ValueError,
+                     OSError)
+
+
+def _get_failed_record(index, operation, error, start_time) -> dict:
+    print(bold_red('操作{}（{}）失败：{}'.format(index, operation['op'], error)))
+    return {'index': index, 'op': operation['op'], 'ok': False,
+            'error': str(error) or type(error).__name__,
+            'elapsed': round(time.monotonic() - start_time, 3)}
+
+
+def run_operation(bdwm: BDWM, index, operation) -> dict:
+    """Run the operation and return its result record, errors are recorded instead of raised."""
+    start_time = time.monotonic()
+    try:
+        result = _OPERATIONS[operation['op']][0](bdwm, operation)
+    except _OPERATION_ERRORS as e:
+        return _get_failed_record(index, operation, e, start_time)
+    return {'index': index, 'op': operation['op'], 'ok': True, 'result': result,
+            'elapsed': round(time.monotonic() - start_time, 3)}
+
+
+def _group_operations(operations: List[dict]) -> List[List[int]]:
+    """Split the operation indexes into groups run one after another, consecutive parallel
+    operations are in the same group.
+    """
+    groups = []
+    for index, operation in enumerate(operations):
+        if operation.get('parallel') and groups and operations[groups[-1][-1]].get('parallel'):
+            groups[-1].append(index)
+        else:
+            groups.append([index])
+    return groups
+
+
+def run_operations(bdwm, operations: List[dict], result_file, max_workers=4,
+                   keep_going=False) -> int:
+    """Run the operations with bdwm, a BDWM client or a BDWMPool routing every operation to
+    its "account", or else to an account allowed on its board. The result records are written
+    to result_file as JSON lines in the order of the script. Unless keep_going is True, we
+    stop after the group of operations where the first failure happens.
+    Return the number of failed operations.
+    """
+    def run(index):
+        operation = operations[index]
+        if not isinstance(bdwm, BDWMPool):
+            return run_operation(bdwm, index, operation)
+        start_time = time.monotonic()
+        if operation.get('account'):
+            future = bdwm.submit_to(operation['account'], run_operation, index, operation)
+        else:
+            future = bdwm.submit(get_operation_board(operation), run_operation, index, operation)
+        try:
+            return future.result()
+        except _OPERATION_ERRORS as e:
+            # The pool logs in on the first call of an account, before run_operation starts.
+            return _get_failed_record(index, operation, e, start_time)
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for group in _group_operations(operations):
+            records = [run(group[0])] if len(group) == 1 else list(executor.map(run, group))
+            for record in records:
+                result_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                failures += not record['ok']
+            result_file.flush()
+            if failures and not keep_going:
+                skipped = len(operations) - group[-1] - 1
+                if skipped:
+                    print(bold_red('跳过剩余的{}个操作'.format(skipped)))
+                break
+    return failures
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check get_content_from_raw_string against the golden corpus, then time it against the
+previous implementation on large generated inputs.
+
+Usage: python benchmarks/bench_content_encoder.py [-n NUMBER]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils import get_content_from_raw_string  # noqa: E402
+
+GOLDEN_CORPUS = [
+    '',
+    'plain text',
+    '中文内容\n第二行',
+    '\x1b[1;31m红色粗体\x1b[0m正常',
+    '\x1b[m',
+    'a\x1b[4mb\x1b[44;33mc\x1b[39;49md\x1b[1me',
+    'quote " and backslash \\ and \\n',
+    '\x1b[38mdefault fore\x1b[48mdefault back',
+    '\x1b[1;4;32;45m\x1b[0m\x1b[0m',
+    'unfinished \x1b[ sequence',
+    'stray \x1b escape',
+    '\x1b[5;7mblink and reverse are ignored',
+]
+
+
+def _legacy_get_content_from_raw_string(content_string):
+    """get_content_from_raw_string before the single-pass rewrite."""
+    parts = content_string.split('\u001B[')
+    change_font = content_string.startswith('\u001B[')
+    template = '{{"type":"ansi","bold":{},"underline":{},"fore_color":{},' \
+               '"back_color":{},"content":"{}"}}'
+    bold, underline, fore_color, back_color = 'false', 'false', 9, 9
+    res = []
+    for part in parts:
+        pos = part.find('m')
+        # The first part may not change font.
+        if not change_font:
+            pos = -1
+            change_font = True
+        if pos > -1:
+            font_codes = part[:pos].split(';')
+            if len(font_codes) == 1 and font_codes[0] == '':
+                font_codes[0] = '0'
+            for code in font_codes:
+                code = int(code)
+                if code in range(30, 40):
+                    fore_color = code - 30 if code <= 37 else 9
+                elif code in range(40, 50):
+                    back_color = code - 40 if code <= 47 else 9
+                elif code == 1:
+                    bold = 'true'
+                elif code == 4:
+                    underline = 'true'
+                elif code == 0:
+                    bold, underline, fore_color, back_color = 'false', 'false', 9, 9
+                else:
+                    pass
+        content = part[pos + 1:].replace("\\", '\\\\') \
+                                .replace('\"', '\\\"') \
+                                .replace('\n', '\\n')
+        res.append(template.format(bold, underline, fore_color, back_color, content))
+
+    return '[{}]'.format(','.join(res)).replace('\x1b', '')
+
+
+def generate_ansi_text(segments, seed=0):
+    """Generate text like a board report, with a font change from a small palette every few
+    words.
+    """
+    rng = random.Random(seed)
+    words = ['版面', '在线', '发帖数', 'WMReview', '"引用"', 'C:\\path', '统计\n', '1234', ' ']
+    font_codes = ['', '0', '1', '1;31', '1;32', '33', '4;36', '0;44;37', '1;4;35;47', '39;49']
+    parts = []
+    for _ in range(segments):
+        parts.append('\x1b[{}m'.format(rng.choice(font_codes)))
+        parts.append(''.join(rng.choice(words) for _ in range(rng.randint(0, 6))))
+    return ''.join(parts)
+
+
+def check_golden_corpus():
+    corpus = GOLDEN_CORPUS + [generate_ansi_text(200, seed) for seed in range(20)]
+    for content_string in corpus:
+        result = get_content_from_raw_string(content_string)
+        if result != _legacy_get_content_from_raw_string(content_string):
+            sys.exit('Different from the previous implementation: {!r}'.format(content_string))
+        json.loads(result)
+    # The previous implementation leaves these control characters unescaped.
+    json.loads(get_content_from_raw_string('tab\there\rand\x00\x1f\x1b[1mbold\x7f'))
+    print('Golden corpus: {} inputs match.'.format(len(corpus)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=20, help='Encodes of every input')
+    args = parser.parse_args()
+
+    check_golden_corpus()
+    print('{:<16}{:>14}{:>14}{:>10}'.format('font changes', 'legacy (ms)', 'new (ms)', 'speedup'))
+    for segments in (100, 1000, 10000):
+        content_string = generate_ansi_text(segments)
+        legacy_time = timeit.timeit(
+            lambda: _legacy_get_content_from_raw_string(content_string), number=args.number)
+        new_time = timeit.timeit(
+            lambda: get_content_from_raw_string(content_string), number=args.number)
+        print('{:<16}{:>14.3f}{:>14.3f}{:>9.1f}x'.format(
+            segments, legacy_time * 1000 / args.number, new_time * 1000 / args.number,
+            legacy_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
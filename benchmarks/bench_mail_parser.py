@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the fast mail list parser with the BeautifulSoup one on the saved mail pages.
+
+Usage: python benchmarks/bench_mail_parser.py [-n NUMBER]
+"""
+import argparse
+import glob
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from parsers import _get_mail_items_fast, _get_mail_items_with_soup  # noqa: E402
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=200, help='Parses of every page')
+    args = parser.parse_args()
+
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, 'mail_page_*.html'))):
+        with open(path, 'r') as f:
+            pages.append((os.path.basename(path), f.read()))
+
+    for name, page in pages:
+        fast_result = _get_mail_items_fast(page)
+        soup_result = _get_mail_items_with_soup(page)
+        if fast_result != soup_result:
+            sys.exit('{}: the fast parser gives a different result!'.format(name))
+
+    print('{:<20}{:>12}{:>12}{:>10}'.format('page', 'soup (ms)', 'fast (ms)', 'speedup'))
+    for name, page in pages:
+        soup_time = timeit.timeit(
+            lambda: _get_mail_items_with_soup(page), number=args.number)
+        fast_time = timeit.timeit(lambda: _get_mail_items_fast(page), number=args.number)
+        print('{:<20}{:>12.3f}{:>12.3f}{:>9.1f}x'.format(
+            name, soup_time * 1000 / args.number, fast_time * 1000 / args.number,
+            soup_time / fast_time))
+
+
+if __name__ == '__main__':
+    main()
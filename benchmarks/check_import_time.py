@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that importing the CLI stays fast: the cumulative import time of BDWM_cli must be within
+the budget, and the modules only needed by a few commands must not be imported at startup.
+
+Usage: python benchmarks/check_import_time.py [--budget MILLISECONDS] [--repeat N]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+MODULE = 'BDWM_cli'
+# Modules which take long to import and are loaded on first use.
+DEFERRED_MODULES = ['bs4', 'dateutil', 'asyncio', 'sqlite3']
+
+_IMPORT_TIME_PATTERN = re.compile(r'^import time:\s*\d+\s*\|\s*(\d+)\s*\|\s*(\S+)\s*$')
+
+
+def _measure_import_time() -> float:
+    """Import the module in a fresh interpreter, return its cumulative import time in ms."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(MODULE)],
+        cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    for line in result.stderr.splitlines():
+        match = _IMPORT_TIME_PATTERN.match(line)
+        if match and match.group(2) == MODULE:
+            return int(match.group(1)) / 1000
+    raise RuntimeError('Cannot find the import time of {}:\n{}'.format(MODULE, result.stderr))
+
+
+def _get_loaded_deferred_modules():
+    code = 'import sys, {}; print(" ".join(m for m in {!r} if m in sys.modules))'.format(
+        MODULE, DEFERRED_MODULES)
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, stdout=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    return result.stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=200,
+                        help='The maximum cumulative import time in milliseconds')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Runs to measure, the fastest one is compared with the budget')
+    args = parser.parse_args()
+
+    import_time = min(_measure_import_time() for _ in range(args.repeat))
+    print('import {}: {:.1f} ms (budget {:.0f} ms)'.format(MODULE, import_time, args.budget))
+    errors = []
+    if import_time > args.budget:
+        errors.append('Importing {} is over the budget'.format(MODULE))
+    loaded_modules = _get_loaded_deferred_modules()
+    if loaded_modules:
+        errors.append('Imported at startup: {}'.format(', '.join(loaded_modules)))
+    if errors:
+        sys.exit('\n'.join(errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A local stand-in of the BDWM server for benchmarks, implementing the endpoints used by the
+client with configurable latency and error injection.
+
+Usage: python benchmarks/mock_server.py [--port PORT] [--latency SECONDS] [--error-rate RATE]
+Then point the client to it with BDWM_BASE_URL=http://127.0.0.1:PORT/v2
+"""
+import argparse
+import datetime
+import html
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+MAILS_PER_PAGE = 20
+POSTS_PER_PAGE = 30
+# Mails are sent every MAIL_INTERVAL before MAIL_START_TIME, the newest first.
+MAIL_START_TIME = datetime.datetime(2020, 11, 30, 23, 59, 0)
+MAIL_INTERVAL = datetime.timedelta(minutes=30)
+# postid of the post with internal number num is POSTID_BASE + num.
+POSTID_BASE = 17000000
+# The collection directory of WMReview, filled with collection_depth levels of directories.
+COLLECTION_ROOT = 'groups/GROUP_0/WMReview'
+
+_PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>北大未名BBS</title></head>
+<body>
+<div id="page-head"><a class="username" href="user.php">{username}</a></div>
+<div id="page-content">
+{content}
+</div>
+</body>
+</html>
+'''
+_MAIL_ITEM_TEMPLATE = '''<div class="list-item row-wrapper" data-itemid="{postid}">
+<a class="link" href="mail-read.php?postid={postid}"></a>
+<div class="sender l"><span class="name">deliver</span></div>
+<div class="title l">投稿 {postid}</div>
+<span class="time l">{time}</span>
+</div>
+'''
+_POST_CARD_TEMPLATE = '''<div class="post-card" data-postid="{postid}">
+<div class="post-owner"><p class="username"><a href="user.php?uid=1">{author}</a></p></div>
+<div class="post-main">
+<div class="post-info"><span class="floor">#{floor}</span>
+<span class="post-time">发表于 {time}</span></div>
+<div class="file-read" data-content="{content}">{lines}</div>
+</div>
+</div>
+'''
+
+
+class MockBDWMState:
+    """Everything the mock server remembers, shared by all the request handlers."""
+
+    def __init__(self, mail_count=2000, thread_post_count=1000, collection_depth=0,
+                 latency=0.0, error_rate=0.0, seed=0):
+        self.mail_count = mail_count
+        # Every thread has this many posts.
+        self.thread_post_count = thread_post_count
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._next_id = 0
+        # {api path: [collection item]}
+        self._collections = {}
+        if collection_depth:
+            self.build_collection_tree(COLLECTION_ROOT, collection_depth)
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def new_id(self):
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def login(self, username):
+        skey = '{:016x}'.format(self.new_id())
+        with self._lock:
+            self._sessions[skey] = username
+        return skey
+
+    def get_username(self, cookie_header):
+        cookies = dict(
+            part.strip().split('=', 1) for part in cookie_header.split(';') if '=' in part)
+        with self._lock:
+            return self._sessions.get(cookies.get('skey'))
+
+    def get_collection_items(self, path):
+        with self._lock:
+            return list(self._collections.get(path, []))
+
+    def build_collection_tree(self, base, depth, dirs_per_dir=5, files_per_dir=10):
+        """Fill the collection directory at base with depth levels of directories."""
+        for i in range(files_per_dir):
+            self.add_collection_item(base, '文章{}'.format(i), isdir=False)
+        if depth <= 0:
+            return
+        for i in range(dirs_per_dir):
+            name = self.add_collection_item(base, '目录{}'.format(i), isdir=True)
+            self.build_collection_tree(base + '/' + name, depth - 1, dirs_per_dir, files_per_dir)
+
+    def add_collection_item(self, base, title, isdir):
+        name = '{}{:08X}'.format('D' if isdir else 'M', self.new_id())
+        with self._lock:
+            self._collections.setdefault(base, []).append(
+                {'title': title, 'path': name, 'isdir': isdir})
+        return name
+
+
+def render_mail_page(state: MockBDWMState, username, page):
+    items = []
+    first_index = (page - 1) * MAILS_PER_PAGE
+    for index in range(first_index, min(first_index + MAILS_PER_PAGE, state.mail_count)):
+        mail_time = MAIL_START_TIME - index * MAIL_INTERVAL
+        items.append(_MAIL_ITEM_TEMPLATE.format(
+            postid=POSTID_BASE + state.mail_count - index,
+            time=mail_time.strftime('%Y-%m-%d %H:%M:%S')))
+    content = '<div id="mail-list" class="list">\n{}</div>'.format(''.join(items))
+    return _PAGE_TEMPLATE.format(username=username, content=content)
+
+
+def render_thread_page(state: MockBDWMState, username, threadid, page):
+    cards = []
+    first_index = (page - 1) * POSTS_PER_PAGE
+    for index in range(first_index, min(first_index + POSTS_PER_PAGE, state.thread_post_count)):
+        floor = index + 1
+        lines = ['第{}楼的内容'.format(floor),
+                 '引用 "第{}楼" \\ 的内容'.format(floor - 1)]
+        content = [
+            {'type': 'ansi', 'bold': True, 'underline': False, 'fore_color': 1,
+             'back_color': 9, 'content': lines[0] + '\n'},
+            {'type': 'ansi', 'bold': False, 'underline': False, 'fore_color': 9,
+             'back_color': 9, 'content': lines[1]},
+        ]
+        post_time = MAIL_START_TIME + index * MAIL_INTERVAL
+        cards.append(_POST_CARD_TEMPLATE.format(
+            postid=threadid + index, author='user{}'.format(floor % 50), floor=floor,
+            time=post_time.strftime('%Y-%m-%d %H:%M:%S'),
+            content=html.escape(json.dumps(content, ensure_ascii=False)),
+            lines=''.join('<p>{}</p>'.format(html.escape(line)) for line in lines)))
+    page_count = max((state.thread_post_count - 1) // POSTS_PER_PAGE + 1, 1)
+    links = ''.join(
+        '<a class="page-jump" href="post-read.php?threadid={}&amp;page={}">{}</a>'.format(
+            threadid, number, number)
+        for number in sorted({1, max(page - 1, 1), page, min(page + 1, page_count), page_count}))
+    content = '<div id="post-read">\n{}</div>\n<div class="paging">{}</div>'.format(
+        ''.join(cards), links)
+    return _PAGE_TEMPLATE.format(username=username, content=content)
+
+
+def render_fixture_page(name, username):
+    path = os.path.join(FIXTURE_DIR, name)
+    if not os.path.exists(path):
+        return _PAGE_TEMPLATE.format(username=username, content='')
+    with open(path, 'r') as f:
+        return f.read().replace('>PES<', '>{}<'.format(username))
+
+
+class MockBDWMHandler(BaseHTTPRequestHandler):
+    state: MockBDWMState = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='text/html; charset=utf-8', headers=()):
+        data = body.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, result, headers=()):
+        self._send(200, json.dumps(result), 'application/json', headers)
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf8') if length else ''
+        params.update(
+            {key: values[-1] for key, values in urllib.parse.parse_qs(body).items()})
+
+        if self.state.latency:
+            time.sleep(self.state.latency * random.uniform(0.5, 1.5))
+        if self.state.should_fail():
+            self._send(503, 'Service Unavailable', headers=[('Retry-After', '0')])
+            return
+
+        action = url.path[len('/v2/'):-len('.php')] if url.path.startswith('/v2/') else ''
+        if action == 'ajax/login':
+            skey = self.state.login(params.get('username', ''))
+            self._send_json({'success': True}, headers=[
+                ('Set-Cookie', 'skey={}; Path=/'.format(skey)),
+                ('Set-Cookie', 'uid={}; Path=/'.format(self.state.new_id())),
+            ])
+            return
+
+        username = self.state.get_username(self.headers.get('Cookie', ''))
+        if action.startswith('ajax/'):
+            self._handle_ajax(action[len('ajax/'):], params, username)
+        elif action == 'mail':
+            page = int(params.get('page', 1))
+            self._send(200, render_mail_page(self.state, username or '', page))
+        elif action == 'thread':
+            page_name = 'board_page_{}.html'.format(params.get('page', 1))
+            self._send(200, render_fixture_page(page_name, username or ''))
+        elif action == 'post-read':
+            threadid, page = int(params.get('threadid', 0)), int(params.get('page', 1))
+            self._send(200, render_thread_page(self.state, username or '', threadid, page))
+        elif action in ('post-read-single', 'mail-read'):
+            self._send(200, render_fixture_page('{}.html'.format(action), username or ''))
+        else:
+            self._send(404, 'Not Found')
+
+    def _handle_ajax(self, action, params, username):
+        if username is None:
+            self._send_json({'success': False, 'error': 'not logged in'})
+        elif action == 'create_post':
+            postid = POSTID_BASE + self.state.new_id()
+            self._send_json({'success': True, 'result': {'postid': postid}})
+        elif action in ('edit_post', 'forward', 'operate_post'):
+            self._send_json({'success': True})
+        elif action == 'get_post_by_num':
+            postid = POSTID_BASE + int(params['num'])
+            self._send_json({'success': True, 'list': [{'postid': postid}]})
+        elif action == 'get_collection_items':
+            items = self.state.get_collection_items(params['path'])
+            self._send_json({'success': True, 'result': items})
+        elif action == 'create_collection_dir':
+            name = self.state.add_collection_item(params['base'], params['title'], isdir=True)
+            self._send_json({'success': True, 'name': name})
+        elif action == 'collection_import':
+            name = self.state.add_collection_item(
+                params['base'], '帖子{}'.format(params['postid']), isdir=False)
+            self._send_json({'success': True, 'name': name})
+        else:
+            self._send_json({'success': False, 'error': 'unknown action'})
+
+
+def start_mock_server(port=0, **state_options) -> ThreadingHTTPServer:
+    """Start the mock server in a background thread, port 0 means any free port.
+    The server is at http://127.0.0.1:{server.server_port}/v2, call server.shutdown() to stop.
+    """
+    handler = type('Handler', (MockBDWMHandler,), {'state': MockBDWMState(**state_options)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Average latency of every request in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Rate of requests answered with 503')
+    parser.add_argument('--mail-count', type=int, default=2000)
+    parser.add_argument('--thread-post-count', type=int, default=1000)
+    parser.add_argument('--collection-depth', type=int, default=3,
+                        help='Levels of directories in the collection of WMReview')
+    args = parser.parse_args()
+
+    server = start_mock_server(args.port, latency=args.latency, error_rate=args.error_rate,
+                               mail_count=args.mail_count,
+                               thread_post_count=args.thread_post_count,
+                               collection_depth=args.collection_depth)
+    print('Mock BDWM server at http://127.0.0.1:{}/v2'.format(server.server_port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time the CLI commands end to end against the local mock server, and compare the results
+with the previous runs to catch regressions.
+
+Usage: python benchmarks/run_benchmarks.py [--repeat N] [--latency SECONDS] [--error-rate RATE]
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Tuple
+
+from mock_server import MAIL_INTERVAL, MAIL_START_TIME, start_mock_server
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+CLI_PATH = os.path.join(REPO_DIR, 'BDWM_cli.py')
+RESULTS_PATH = os.path.join(BENCHMARK_DIR, 'results.jsonl')
+USER_ID = 'PES'
+# The mock server doesn't throttle, run at the rates of a fast server instead of the defaults
+# kept for the real one.
+RATE_OPTIONS = ['--read-rate', '50', '--post-rate', '20', '--moderate-rate', '20']
+
+
+def _get_benchmarks():
+    """{name: CLI arguments after the user options}"""
+    # 40 mails from 400 mails ago, which is on page 21.
+    end = MAIL_START_TIME - 400 * MAIL_INTERVAL
+    start = end - 39 * MAIL_INTERVAL
+    return {
+        'post': ['post', '-b', 'Test', '--title', 'benchmark', '--content', 'benchmark'],
+        'import_collection': [
+            'import-collection', '-b', 'WMReview', '--path', '历期起居注/2020年11月',
+            '--create-if-not-exists', '--in-postids', '1~200'],
+        'mirror_collection': ['mirror-collection', '-b', 'WMReview'],
+        'export_thread': [
+            'export-thread', '-b', 'Test', '--threadid', '18000000', '-o', os.devnull],
+        'forward_mail_within_time_range': [
+            'forward-mail-within-time-range', '-b', 'Test', '--start', str(start),
+            '--end', str(end), '--start-post=', '--end-post='],
+    }
+
+
+def _run_command(arguments, env) -> Tuple[float, bool]:
+    """Run the CLI command, return the elapsed time and whether it succeeded."""
+    command = [sys.executable, CLI_PATH] + RATE_OPTIONS + arguments[:1] + [
+        '--id', USER_ID, '--password-file', env['BENCHMARK_PASSWORD_FILE']] + arguments[1:]
+    start_time = time.monotonic()
+    # board.json is read from the working directory.
+    result = subprocess.run(command, cwd=REPO_DIR, env=env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    elapsed = time.monotonic() - start_time
+    if result.returncode != 0:
+        print('{} failed:\n{}'.format(arguments[0], result.stderr[-2000:]), file=sys.stderr)
+    return elapsed, result.returncode == 0
+
+
+def _get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def _load_previous_results(path):
+    results = []
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            results = [json.loads(line) for line in f if line.strip()]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs of every benchmark')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Average latency of the mock server in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Rate of requests answered with 503 by the mock server')
+    parser.add_argument('--only', action='append', help='Only run these benchmarks')
+    parser.add_argument('--results', default=RESULTS_PATH, help='The file keeping all results')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Fail if a benchmark is slower than the median of previous runs '
+                             'by this ratio')
+    args = parser.parse_args()
+
+    server = start_mock_server(latency=args.latency, error_rate=args.error_rate,
+                               collection_depth=3)
+    settings = {'latency': args.latency, 'error_rate': args.error_rate}
+    previous_results = _load_previous_results(args.results)
+    regressions = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        password_file = os.path.join(temp_dir, 'password')
+        with open(password_file, 'w') as f:
+            f.write('benchmark')
+        env = dict(os.environ,
+                   BDWM_BASE_URL='http://127.0.0.1:{}/v2'.format(server.server_port),
+                   BENCHMARK_PASSWORD_FILE=password_file,
+                   # Keep the caches of benchmarks away from the real ones.
+                   XDG_CACHE_HOME=os.path.join(temp_dir, 'cache'))
+
+        print('{:<34}{:>10}{:>10}{:>12}'.format('benchmark', 'median s', 'min s', 'previous s'))
+        for name, arguments in _get_benchmarks().items():
+            if args.only and name not in args.only:
+                continue
+            runs = [_run_command(arguments, env) for _ in range(args.repeat)]
+            times = [elapsed for elapsed, _ in runs]
+            failed_runs = sum(not ok for _, ok in runs)
+            if failed_runs and not args.error_rate:
+                sys.exit('{} failed without error injection!'.format(name))
+            result = {
+                'benchmark': name,
+                'median': statistics.median(times),
+                'min': min(times),
+                'repeat': args.repeat,
+                'failed_runs': failed_runs,
+                'settings': settings,
+                'commit': _get_git_commit(),
+                'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            }
+            previous_medians = [r['median'] for r in previous_results
+                                if r['benchmark'] == name and r['settings'] == settings]
+            baseline = statistics.median(previous_medians) if previous_medians else None
+            print('{:<34}{:>10.3f}{:>10.3f}{:>12}'.format(
+                name, result['median'], result['min'],
+                '{:.3f}'.format(baseline) if baseline else '-'))
+            if baseline and result['median'] > baseline * (1 + args.threshold):
+                regressions.append(name)
+            with open(args.results, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+    server.shutdown()
+
+    if regressions:
+        sys.exit('Slower than previous runs: {}'.format(', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Index of the boards in board.json.
+"""
+import difflib
+from hashlib import md5
+import json
+import os
+import pickle
+import threading
+from typing import List, Optional
+
+from utils import get_cache_path
+
+
+class BoardRegistry:
+    """Boards indexed by name, lower-case name, bid and section."""
+    _CACHE_VERSION = 1
+
+    def __init__(self, boards: dict):
+        self._boards = boards
+        self._names_by_lower_name = {name.lower(): name for name in boards}
+        self._names_by_bid = {}
+        self._names_by_section = {}
+        for name, board_info in boards.items():
+            if 'id' in board_info:
+                self._names_by_bid[board_info['id']] = name
+            self._names_by_section.setdefault(board_info.get('section'), []).append(name)
+
+    @classmethod
+    def load(cls, config_path) -> 'BoardRegistry':
+        """Load the boards in config_path, using the compiled cache if the file isn't changed
+        after the cache is written.
+        """
+        stat = os.stat(config_path)
+        file_key = (stat.st_mtime_ns, stat.st_size)
+        cache_name = md5(os.path.abspath(config_path).encode('utf8')).hexdigest()
+        try:
+            cache_path = get_cache_path('board_registry', cache_name + '.pickle')
+            with open(cache_path, 'rb') as f:
+                version, cached_file_key, registry = pickle.load(f)
+            if version == cls._CACHE_VERSION and cached_file_key == file_key:
+                return registry
+        except (OSError, pickle.PickleError, EOFError, ValueError, TypeError):
+            pass
+
+        with open(config_path) as f:
+            registry = cls(json.load(f))
+        # The cache only saves time, boards are still read from config_path without it.
+        try:
+            cache_path = get_cache_path('board_registry', cache_name + '.pickle')
+            tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((cls._CACHE_VERSION, file_key, registry), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+        return registry
+
+    def __contains__(self, board_name):
+        return self.get_name(board_name) is not None
+
+    def __len__(self):
+        return len(self._boards)
+
+    def get_name(self, board_name) -> Optional[str]:
+        """Get the real name of a board, the board_name is case-insensitive."""
+        if board_name in self._boards:
+            return board_name
+        return self._names_by_lower_name.get(board_name.lower())
+
+    def get(self, board_name) -> Optional[dict]:
+        name = self.get_name(board_name)
+        return self._boards[name] if name else None
+
+    def get_name_by_bid(self, bid: int) -> Optional[str]:
+        return self._names_by_bid.get(int(bid))
+
+    def get_section_boards(self, section) -> List[str]:
+        return list(self._names_by_section.get(str(section), []))
+
+    def find_similar_names(self, board_name, n=3) -> List[str]:
+        lower_names = difflib.get_close_matches(
+            board_name.lower(), self._names_by_lower_name, n=n, cutoff=0.6)
+        return [self._names_by_lower_name[lower_name] for lower_name in lower_names]
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_board_registry(config_path='board.json') -> BoardRegistry:
+    """Get the registry of config_path, which is loaded only once in a process."""
+    key = os.path.abspath(config_path)
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = BoardRegistry.load(config_path)
+        return _registries[key]
+
+
+def normalize_board_name(board_name, config_path='board.json') -> str:
+    """Get the real name of a board for keys of local data, so that "wmreview" and "WMReview"
+    share them. Unknown boards are kept as they are.
+    """
+    return get_board_registry(config_path).get_name(board_name) or board_name
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk operations built on a BDWM client.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+import json
+import threading
+from typing import List, Optional, Tuple
+
+import requests
+
+from BDWM import BDWM
+from board_registry import normalize_board_name
+from utils import get_cache_path, bold_red, bold_yellow
+
+
+class ImportJournal:
+    """Append-only record of the posts already imported into a collection directory, one JSON
+    object per line, so that an interrupted import can be resumed.
+    """
+
+    def __init__(self, path, resume=False):
+        self._path = path
+        self._lock = threading.Lock()
+        self._imported = {}
+        if resume:
+            self._load()
+        self._file = open(path, 'a' if resume else 'w')
+
+    @classmethod
+    def get_default_path(cls, board_name, api_path):
+        path_hash = md5(api_path.encode('utf8')).hexdigest()[:12]
+        return get_cache_path('import_journals', '{}-{}.jsonl'.format(
+            normalize_board_name(board_name), path_hash))
+
+    def _load(self):
+        try:
+            with open(self._path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut off when the previous run was killed.
+                        continue
+                    self._imported[str(entry['postid'])] = entry['name']
+        except FileNotFoundError:
+            pass
+
+    def is_imported(self, postid) -> bool:
+        return str(postid) in self._imported
+
+    def record(self, postid, name):
+        with self._lock:
+            self._imported[str(postid)] = name
+            self._file.write(json.dumps({'postid': postid, 'name': name}) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def import_collection_items(bdwm: BDWM, board_name, api_path, postid_list,
+                            journal: ImportJournal, ordered=False, max_workers=4) -> List:
+    """Add the posts into the collection directory at api_path, skipping the ones already in
+    journal. Up to max_workers posts are imported at the same time, unless ordered is True,
+    when the posts are imported one by one in the given order and we stop at the first
+    failure, so that a resumed run keeps the order.
+    Return the postids failed to import.
+    """
+    pending = [postid for postid in postid_list if not journal.is_imported(postid)]
+    if len(pending) < len(postid_list):
+        print(bold_yellow('跳过已导入的{}个帖子'.format(len(postid_list) - len(pending))))
+
+    def import_item(postid):
+        try:
+            name = bdwm.add_new_collection(board_name, api_path, int(postid))
+        except (BDWM.RequestError, requests.RequestException, ValueError) as e:
+            print(bold_red('帖子{}导入失败：{}'.format(postid, e)))
+            return False
+        journal.record(postid, name)
+        return True
+
+    if ordered:
+        for i, postid in enumerate(pending):
+            if not import_item(postid):
+                return pending[i:]
+        return []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(import_item, pending))
+    return [postid for postid, ok in zip(pending, results) if not ok]
+
+
+def operate_posts_in_chunks(bdwm: BDWM, board_name, postid_list, action, chunk_size=20,
+                            max_workers=4) -> List[Tuple[List, Optional[str]]]:
+    """Operate the posts in chunks of at most chunk_size posts, sending up to max_workers
+    chunks at the same time. Return every chunk with its error message, which is None if the
+    chunk succeeded.
+    """
+    assert chunk_size > 0, 'chunk_size should be positive!'
+    chunks = [postid_list[i:i + chunk_size] for i in range(0, len(postid_list), chunk_size)]
+
+    def operate_chunk(chunk):
+        try:
+            bdwm.operate_post(board_name, chunk, action)
+        except (BDWM.RequestError, requests.RequestException, ValueError) as e:
+            return str(e) or type(e).__name__
+        return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(zip(chunks, executor.map(operate_chunk, chunks)))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local caches of data fetched from BDWM.
+"""
+from hashlib import sha1
+import threading
+import time
+from typing import Optional
+import zlib
+
+from board_registry import normalize_board_name
+from utils import get_cache_path, load_json_file, dump_json_file
+
+
+class PostNumCache:
+    """Persistent mapping from the internal post number of a board to the postid.
+    A number never changes its post once assigned, so the entries never expire.
+    """
+
+    def __init__(self, board_name, path=None):
+        self._path = path or get_cache_path(
+            'post_num', '{}.json'.format(normalize_board_name(board_name)))
+        self._lock = threading.Lock()
+        self._postids = load_json_file(self._path, default={})
+        self._dirty = False
+
+    def get(self, internal_postid: int) -> Optional[int]:
+        return self._postids.get(str(internal_postid))
+
+    def put(self, internal_postid: int, postid: int):
+        with self._lock:
+            self._postids[str(internal_postid)] = postid
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if self._dirty:
+                dump_json_file(self._path, self._postids)
+                self._dirty = False
+
+
+class CollectionPathCache:
+    """Cache from (board name, collection directory path we see on the website) to the api
+    path of the directory. Entries expire after ttl seconds, and are also kept in the file
+    at path if it's given.
+    """
+    _DEFAULT_TTL = 24 * 3600
+
+    def __init__(self, ttl: float = _DEFAULT_TTL, path=None):
+        self._ttl = ttl
+        self._path = path
+        self._lock = threading.Lock()
+        # {board_name: {directory_path: [api_path, cached_time]}}
+        self._entries = load_json_file(path, default={}) if path else {}
+        self._dirty = False
+
+    def _is_expired(self, entry):
+        return time.time() - entry[1] > self._ttl
+
+    def get(self, board_name, directory_path) -> Optional[str]:
+        with self._lock:
+            board_entries = self._entries.get(board_name, {})
+            entry = board_entries.get(directory_path)
+            if entry is None:
+                return None
+            if self._is_expired(entry):
+                del board_entries[directory_path]
+                self._dirty = True
+                return None
+            return entry[0]
+
+    def put(self, board_name, directory_path, api_path):
+        with self._lock:
+            self._entries.setdefault(board_name, {})[directory_path] = [api_path, time.time()]
+            self._dirty = True
+
+    def add_child(self, parent_api_path, title, name):
+        """Record a directory named name just created with title under parent_api_path."""
+        with self._lock:
+            for board_name, board_entries in self._entries.items():
+                for directory_path, entry in board_entries.items():
+                    if entry[0] == parent_api_path and not self._is_expired(entry):
+                        child_path = directory_path + '/' + title if directory_path else title
+                        board_entries[child_path] = [parent_api_path + '/' + name, time.time()]
+                        self._dirty = True
+                        return
+
+    def invalidate(self, board_name, directory_path=''):
+        """Drop the cached directory and all its sub-directories, use it when the collection
+        tree is changed outside this tool. The whole board is dropped by default.
+        """
+        directory_path = directory_path.strip('/')
+        with self._lock:
+            board_entries = self._entries.get(board_name, {})
+            for cached_path in list(board_entries):
+                if (not directory_path or cached_path == directory_path
+                        or cached_path.startswith(directory_path + '/')):
+                    del board_entries[cached_path]
+                    self._dirty = True
+
+    def save(self):
+        if not self._path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            for board_entries in self._entries.values():
+                for directory_path, entry in list(board_entries.items()):
+                    if self._is_expired(entry):
+                        del board_entries[directory_path]
+            dump_json_file(self._path, self._entries)
+            self._dirty = False
+
+
+class CachedResponse:
+    __slots__ = ('key', 'content', 'etag', 'last_modified', 'is_fresh')
+
+    def __init__(self, key, content, etag, last_modified, is_fresh):
+        self.key = key
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.is_fresh = is_fresh
+
+    def get_conditional_headers(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """On-disk cache of fetched pages keyed by url and user, the pages are stored compressed
+    in a SQLite database. Entries expire after the ttl of their endpoint, but are kept for
+    revalidation, and the least recently used ones are evicted when the cache is larger than
+    max_size bytes.
+    """
+    # {action name: ttl in seconds}, pages of other actions are not cached.
+    DEFAULT_TTLS = {
+        'thread': 60,
+        'post-read': 300,
+        'post-read-single': 600,
+        'mail': 30,
+        'mail-read': 24 * 3600,
+    }
+    _DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            action TEXT NOT NULL,
+            bid INTEGER,
+            threadid INTEGER,
+            postid INTEGER,
+            body BLOB NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS responses_action_bid ON responses (action, bid);
+        CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+    '''
+
+    def __init__(self, path=None, max_size: int = _DEFAULT_MAX_SIZE, ttls: dict = None):
+        # Only pay for importing sqlite3 when the cache is turned on.
+        import sqlite3
+        self._connection = sqlite3.connect(
+            path or get_cache_path('responses.sqlite3'), check_same_thread=False)
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._ttls = dict(self.DEFAULT_TTLS, **(ttls or {}))
+        with self._connection:
+            self._connection.executescript(self._SCHEMA)
+
+    @classmethod
+    def _get_key(cls, user, url):
+        return sha1('{}\n{}'.format(user, url).encode('utf8')).hexdigest()
+
+    def is_cacheable(self, action_name) -> bool:
+        return action_name in self._ttls
+
+    def get(self, user, action_name, url) -> Optional[CachedResponse]:
+        key = self._get_key(user, url)
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                'SELECT body, etag, last_modified, fetched_at FROM responses WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                'UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        body, etag, last_modified, fetched_at = row
+        is_fresh = time.time() - fetched_at <= self._ttls.get(action_name, 0)
+        return CachedResponse(key, zlib.decompress(body).decode('utf8'), etag, last_modified,
+                              is_fresh)
+
+    def put(self, user, action_name, url, params: dict, content, etag=None,
+            last_modified=None):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses (key, action, bid, threadid, postid, body, etag,'
+                ' last_modified, fetched_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self._get_key(user, url), action_name, params.get('bid'),
+                 params.get('threadid'), params.get('postid'),
+                 zlib.compress(content.encode('utf8')), etag, last_modified, now, now))
+            self._evict()
+
+    def refresh(self, cached_response: CachedResponse):
+        """Mark a cached response fresh again, after the server says it's not modified."""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE key = ?',
+                (now, now, cached_response.key))
+
+    def _evict(self):
+        total_size = self._connection.execute(
+            'SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses').fetchone()[0]
+        if total_size <= self._max_size:
+            return
+        # Evict down to 90% of max_size, so that we don't evict on every put.
+        rows = self._connection.execute(
+            'SELECT key, LENGTH(body) FROM responses ORDER BY accessed_at').fetchall()
+        evicted_keys = []
+        for key, size in rows:
+            if total_size <= self._max_size * 0.9:
+                break
+            evicted_keys.append((key,))
+            total_size -= size
+        self._connection.executemany('DELETE FROM responses WHERE key = ?', evicted_keys)
+
+    def invalidate(self, action_name, bid=None, threadid=None, postid=None):
+        """Drop the cached pages of action_name for all users, only the ones matching the given
+        bid, threadid and postid.
+        """
+        conditions, params = ['action = ?'], [action_name]
+        for column, value in (('bid', bid), ('threadid', threadid), ('postid', postid)):
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                params.append(int(value))
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM responses WHERE ' + ' AND '.join(conditions), params)
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Crawl the collection tree of a board into snapshots, and compare snapshots to find out what
+changed.
+"""
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import datetime
+from hashlib import md5
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+from BDWM import BDWM
+from board_registry import normalize_board_name
+from utils import get_cache_path, load_json_file, dump_json_file, bold_red
+
+
+class CollectionSnapshot:
+    """All items under a collection directory, keyed by their api paths relative to the root
+    directory like "D5448A5D2/M86B358DF", in breadth-first order. Every item keeps the fields
+    from the server, and "title_path", the path we see on the website.
+    """
+
+    def __init__(self, board_name, root_api_path, items: Dict[str, dict], created_at=None):
+        self.board_name = board_name
+        self.root_api_path = root_api_path
+        self.items = items
+        self.created_at = created_at or datetime.datetime.now().isoformat(timespec='seconds')
+
+    @classmethod
+    def get_default_path(cls, board_name, root_api_path):
+        path_hash = md5(root_api_path.encode('utf8')).hexdigest()[:12]
+        return get_cache_path('collection_snapshots', '{}-{}.json'.format(
+            normalize_board_name(board_name), path_hash))
+
+    @classmethod
+    def load(cls, path) -> Optional['CollectionSnapshot']:
+        data = load_json_file(path)
+        if not data:
+            return None
+        return cls(data['board'], data['root_api_path'], data['items'], data['created_at'])
+
+    def save(self, path):
+        dump_json_file(path, {
+            'board': self.board_name,
+            'root_api_path': self.root_api_path,
+            'created_at': self.created_at,
+            'items': self.items,
+        })
+
+    def find_directory(self, title_path) -> Optional[str]:
+        """Get the relative api path of the directory with title_path, '' for the root."""
+        title_path = title_path.strip('/')
+        if not title_path:
+            return ''
+        for relative_path, item in self.items.items():
+            if item['isdir'] and item['title_path'] == title_path:
+                return relative_path
+        return None
+
+    def diff(self, previous: 'CollectionSnapshot') -> Dict[str, List[str]]:
+        """Compare with the previous snapshot, return the relative api paths of the "added",
+        "removed" and "changed" items. A moved item is removed from its old path and added to
+        the new one.
+        """
+        return {
+            'added': [path for path in self.items if path not in previous.items],
+            'removed': [path for path in previous.items if path not in self.items],
+            'changed': [path for path, item in self.items.items()
+                        if path in previous.items and previous.items[path] != item],
+        }
+
+
+def _is_in_subtree(relative_path, subtree):
+    return not subtree or relative_path == subtree or relative_path.startswith(subtree + '/')
+
+
+def _order_breadth_first(items: Dict[str, dict]) -> Dict[str, dict]:
+    """Directories are listed in any order, sort their items breadth-first, while the items in
+    a directory keep the order from the server.
+    """
+    children = {}
+    for path in items:
+        children.setdefault(path.rpartition('/')[0], []).append(path)
+    ordered_items = {}
+    queue = deque([''])
+    while queue:
+        for path in children.get(queue.popleft(), []):
+            ordered_items[path] = items[path]
+            queue.append(path)
+    return ordered_items
+
+
+def crawl_collection_tree(bdwm: BDWM, board_name, root_api_path,
+                          previous: CollectionSnapshot = None, subtrees: List[str] = None,
+                          max_workers=8) -> Tuple[CollectionSnapshot, List[str]]:
+    """List the directories breadth-first, up to max_workers at the same time.
+    With previous and subtrees (relative api paths of directories in previous), only these
+    subtrees are listed again and the other items are kept from previous. If listing a
+    directory fails, its items in previous are kept.
+    Return the snapshot and the relative api paths of the directories failed to list.
+    """
+    if subtrees and previous is None:
+        raise ValueError('Subtrees can only be crawled again with a previous snapshot')
+    roots = subtrees or ['']
+    items = {}
+    if previous is not None and subtrees:
+        items = {path: item for path, item in previous.items.items()
+                 if not any(_is_in_subtree(path, subtree) and path != subtree
+                            for subtree in subtrees)}
+
+    def list_directory(relative_path):
+        api_path = root_api_path + '/' + relative_path if relative_path else root_api_path
+        return bdwm.list_collection_items(api_path)
+
+    failed_paths = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(list_directory, root): root for root in roots}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                relative_path = pending.pop(future)
+                try:
+                    children = future.result()
+                except (BDWM.RequestError, requests.RequestException, ValueError) as e:
+                    print(bold_red('获取精华区目录{}失败：{}'.format(relative_path or '/', e)))
+                    failed_paths.append(relative_path)
+                    if previous is not None:
+                        items.update((path, item) for path, item in previous.items.items()
+                                     if _is_in_subtree(path, relative_path) and path)
+                    continue
+                parent_title_path = items[relative_path]['title_path'] if relative_path else ''
+                for child in children:
+                    child_path = relative_path + '/' + child['path'] if relative_path \
+                        else child['path']
+                    items[child_path] = dict(child, title_path='/'.join(
+                        part for part in (parent_title_path, child['title']) if part))
+                    if child['isdir']:
+                        pending[executor.submit(list_directory, child_path)] = child_path
+
+    snapshot = CollectionSnapshot(board_name, root_api_path, _order_breadth_first(items))
+    return snapshot, failed_paths
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions for locating mails in the mailbox by time, and forwarding them.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import threading
+from typing import List, Tuple
+
+import requests
+
+from parsers import MailItem, get_mail_items
+from utils import bold_red
+
+
+class MailPages:
+    """Mail list pages of a client, each page is fetched and parsed only once.
+    Mails are listed from the newest to the oldest, so the times are monotonic over pages.
+    """
+
+    def __init__(self, bdwm):
+        self._bdwm = bdwm
+        self._lock = threading.Lock()
+        self._pages = {}
+        self._seen_page_keys = {}
+
+    def get(self, page: int) -> List[MailItem]:
+        with self._lock:
+            if page in self._pages:
+                return self._pages[page]
+        mails = get_mail_items(self._bdwm.get_mail_content(page=page))
+        with self._lock:
+            # Some servers return the last page for any page number after it, treat a page
+            # repeating an earlier one as empty.
+            page_key = tuple(mail.postid for mail in mails)
+            first_page = self._seen_page_keys.get(page_key, page)
+            if mails and first_page < page:
+                mails = []
+            elif mails and first_page > page:
+                self._pages[first_page] = []
+                self._seen_page_keys[page_key] = page
+            else:
+                self._seen_page_keys[page_key] = page
+            self._pages[page] = mails
+        return mails
+
+    def is_before(self, page: int, time: datetime.datetime) -> bool:
+        """Whether all mails on page are earlier than time, which is true for empty pages."""
+        mails = self.get(page)
+        return not mails or mails[0].time < time
+
+    def is_not_after(self, page: int, time: datetime.datetime) -> bool:
+        """Whether page has a mail not later than time, which is true for empty pages."""
+        mails = self.get(page)
+        return not mails or mails[-1].time <= time
+
+
+def _find_first_page(predicate, low: int, high: int) -> int:
+    """Binary search the first page in [low, high] satisfying the monotonic predicate,
+    predicate(high) must be true.
+    """
+    while low < high:
+        middle = (low + high) // 2
+        if predicate(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return high
+
+
+def locate_mail_pages(mail_pages: MailPages, start: datetime.datetime,
+                      end: datetime.datetime) -> Tuple[int, int]:
+    """Get the first and the last page containing mails within [start, end], with O(log pages)
+    page fetches. The first page is larger than the last one if there are no such mails.
+    """
+    # Gallop to a page all earlier than start, the window ends before it.
+    low, high = 1, 1
+    while not mail_pages.is_before(high, start):
+        low, high = high + 1, high * 2
+    last_page = _find_first_page(lambda page: mail_pages.is_before(page, start), low, high) - 1
+    first_page = _find_first_page(
+        lambda page: mail_pages.is_not_after(page, end), 1, max(last_page, 1))
+    return first_page, last_page
+
+
+def get_mail_postids_within_time_range(bdwm, start: datetime.datetime, end: datetime.datetime,
+                                       max_workers=4) -> List[str]:
+    """Get the postids of mails within [start, end], from the newest to the oldest."""
+    mail_pages = MailPages(bdwm)
+    first_page, last_page = locate_mail_pages(mail_pages, start, end)
+    pages = range(first_page, last_page + 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        page_mails = list(executor.map(mail_pages.get, pages))
+
+    postids = []
+    seen_postids = set()
+    for mails in page_mails:
+        for mail in mails:
+            # A mail may be shown on two pages when new mails arrive during the fetch.
+            if start <= mail.time <= end and mail.postid not in seen_postids:
+                seen_postids.add(mail.postid)
+                postids.append(mail.postid)
+    return postids
+
+
+def forward_mails_to_board(bdwm, board_name, postids: List[str], mail_index=None) -> List[str]:
+    """Forward the mails in the given order, a mail failed to forward is skipped instead of
+    stopping the others. Mails refused by the server are usually deleted, so they are dropped
+    from mail_index (a mail_index.MailIndex) if it's given.
+    Return the postids failed to forward.
+    """
+    failed_postids, refused_postids = [], []
+    for postid in postids:
+        try:
+            bdwm.forward_mail_to_board(board_name, postid)
+        except (bdwm.RequestError, requests.RequestException) as e:
+            print(bold_red('跳过邮件{}：{}'.format(postid, e)))
+            failed_postids.append(postid)
+            if isinstance(e, bdwm.RequestError):
+                refused_postids.append(postid)
+    if mail_index is not None and refused_postids:
+        mail_index.delete_mails(bdwm.id, refused_postids)
+    return failed_postids
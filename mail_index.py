@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local index of the mailbox in SQLite. Mails never change once received, so only the pages with
+mails newer than the last sync are fetched, and time ranges are queried locally.
+
+The index has every mail later than its low-water time and not later than its high-water time,
+the low-water time is NULL once the end of the mailbox is reached.
+"""
+import datetime
+import sqlite3
+import threading
+from typing import Iterable, List, Optional
+
+from mail import MailPages
+from parsers import MailItem
+from utils import get_cache_path, iter_with_prefetch
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS mails (
+    user TEXT NOT NULL,
+    postid INTEGER NOT NULL,
+    time TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    title TEXT NOT NULL,
+    PRIMARY KEY (user, postid)
+);
+CREATE INDEX IF NOT EXISTS mails_user_time ON mails (user, time);
+CREATE TABLE IF NOT EXISTS sync_state (
+    user TEXT PRIMARY KEY,
+    high_water_time TEXT,
+    low_water_time TEXT,
+    synced_at TEXT NOT NULL
+);
+'''
+
+_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _parse_time(time_str) -> Optional[datetime.datetime]:
+    return datetime.datetime.strptime(time_str, _TIME_FORMAT) if time_str else None
+
+
+def _format_time(time: Optional[datetime.datetime]):
+    return time.strftime(_TIME_FORMAT) if time else None
+
+
+class MailIndex:
+    def __init__(self, path=None):
+        self._connection = sqlite3.connect(
+            path or get_cache_path('mail_index.sqlite3'), check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_sync_state(self, user):
+        return self._connection.execute(
+            'SELECT high_water_time, low_water_time FROM sync_state WHERE user = ?',
+            (user,)).fetchone()
+
+    def save_mails(self, user, mails: Iterable[MailItem]):
+        rows = [(user, int(mail.postid), _format_time(mail.time), mail.sender, mail.title)
+                for mail in mails]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO mails (user, postid, time, sender, title)'
+                ' VALUES (?, ?, ?, ?, ?)', rows)
+
+    def clear(self, user):
+        """Forget the mails of user, the next sync fetches the whole mailbox again. Use it after
+        mails are deleted.
+        """
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM mails WHERE user = ?', (user,))
+            self._connection.execute('DELETE FROM sync_state WHERE user = ?', (user,))
+
+    def delete_mails(self, user, postids: Iterable):
+        """Forget mails deleted from the mailbox, they are not listed by the next sync."""
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM mails WHERE user = ? AND postid = ?',
+                                         [(user, int(postid)) for postid in postids])
+
+    def sync(self, bdwm, until: datetime.datetime = None, prefetch=4) -> int:
+        """Fetch the mail pages from the newest one, until the mails older than the last sync
+        if the index already covers until, otherwise until the mails older than until. The
+        whole mailbox is fetched if until is None and the index doesn't cover it yet. Pages are
+        prefetched only in the latter cases.
+        Return the number of mails saved.
+        """
+        user = bdwm.id
+        state = self._get_sync_state(user)
+        high_water_time = _parse_time(state['high_water_time']) if state else None
+        low_water_time = _parse_time(state['low_water_time']) if state else None
+        covered = state is not None and (
+            low_water_time is None or (until is not None and until > low_water_time))
+        stop_time = high_water_time if covered else until
+
+        count = 0
+        reached_end = False
+        oldest_time = None
+        # New mails usually fit in a page or two, pages after them are prefetched for nothing.
+        pages = iter_with_prefetch(MailPages(bdwm).get, prefetch=0 if covered else prefetch)
+        try:
+            for mails in pages:
+                if not mails:
+                    reached_end = True
+                    break
+                self.save_mails(user, mails)
+                count += len(mails)
+                oldest_time = mails[-1].time
+                if high_water_time is None or mails[0].time > high_water_time:
+                    high_water_time = mails[0].time
+                # Mails at the stop time may be shared with the next page, so the page
+                # reaching it is saved again.
+                if stop_time is not None and oldest_time < stop_time:
+                    break
+        finally:
+            pages.close()
+
+        if reached_end:
+            low_water_time = None
+        elif not covered:
+            low_water_time = oldest_time
+        # The marks are saved only after the whole sync, so an interrupted sync is done again
+        # from the previous marks.
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO sync_state'
+                ' (user, high_water_time, low_water_time, synced_at) VALUES (?, ?, ?, ?)',
+                (user, _format_time(high_water_time), _format_time(low_water_time),
+                 _format_time(datetime.datetime.now())))
+        return count
+
+    def get_postids(self, user, start: datetime.datetime, end: datetime.datetime) -> List[str]:
+        """Get the postids of the indexed mails within [start, end], from the newest to the
+        oldest.
+        """
+        rows = self._connection.execute(
+            'SELECT postid FROM mails WHERE user = ? AND time BETWEEN ? AND ?'
+            ' ORDER BY time DESC, postid DESC',
+            (user, _format_time(start), _format_time(end))).fetchall()
+        return [str(row['postid']) for row in rows]
+
+
+def get_indexed_mail_postids_within_time_range(
+        bdwm, start: datetime.datetime, end: datetime.datetime, index: MailIndex) -> List[str]:
+    """Like mail.get_mail_postids_within_time_range, but only the mails newer than the last
+    sync of index are fetched.
+    """
+    index.sync(bdwm, until=start)
+    return index.get_postids(bdwm.id, start, end)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-endpoint metrics of the requests sent to BDWM.
+"""
+import bisect
+import os
+import threading
+from typing import Dict
+
+# Upper bounds of the latency histogram buckets in seconds.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class EndpointStats:
+    __slots__ = ('count', 'failures', 'retries', 'bytes', 'latency_sum', 'latency_max',
+                 'bucket_counts')
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.retries = 0
+        self.bytes = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        # The last bucket is for latencies larger than all the bounds.
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def get_latency_quantile_bound(self, quantile) -> float:
+        """Get the bucket bound which the quantile of latencies is under."""
+        rank = quantile * self.count
+        seen = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS, self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """Call counts, latencies, transferred bytes, retries and failures of every endpoint,
+    like "ajax/login" for actions and "thread" for pages.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints: Dict[str, EndpointStats] = {}
+
+    def _get_stats(self, endpoint) -> EndpointStats:
+        if endpoint not in self._endpoints:
+            self._endpoints[endpoint] = EndpointStats()
+        return self._endpoints[endpoint]
+
+    def record_request(self, endpoint, latency: float, transferred_bytes: int, failed: bool):
+        with self._lock:
+            stats = self._get_stats(endpoint)
+            stats.count += 1
+            stats.failures += failed
+            stats.bytes += transferred_bytes
+            stats.latency_sum += latency
+            stats.latency_max = max(stats.latency_max, latency)
+            stats.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def record_retry(self, endpoint):
+        with self._lock:
+            self._get_stats(endpoint).retries += 1
+
+    def record_failure(self, endpoint):
+        """Record a failure of a request which is sent successfully but refused by the server."""
+        with self._lock:
+            self._get_stats(endpoint).failures += 1
+
+    def format_summary(self) -> str:
+        lines = ['{:<32}{:>7}{:>7}{:>9}{:>10}{:>10}{:>10}{:>10}'.format(
+            'endpoint', 'calls', 'fails', 'retries', 'avg ms', 'max ms', 'p95<=ms', 'KB')]
+        with self._lock:
+            for endpoint, stats in sorted(self._endpoints.items()):
+                average = stats.latency_sum / stats.count if stats.count else 0
+                lines.append('{:<32}{:>7}{:>7}{:>9}{:>10.0f}{:>10.0f}{:>10.0f}{:>10.1f}'.format(
+                    endpoint, stats.count, stats.failures, stats.retries, average * 1000,
+                    stats.latency_max * 1000, stats.get_latency_quantile_bound(0.95) * 1000,
+                    stats.bytes / 1024))
+        return '\n'.join(lines)
+
+    def format_prometheus(self, prefix='bdwm') -> str:
+        """Format the metrics in the Prometheus text exposition format."""
+        counters = [
+            ('requests_total', 'Requests sent.', 'count'),
+            ('request_failures_total', 'Requests failed or refused.', 'failures'),
+            ('request_retries_total', 'Requests retried after transient failures.', 'retries'),
+            ('response_bytes_total', 'Bytes of responses received.', 'bytes'),
+        ]
+        lines = []
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            for name, help_text, attribute in counters:
+                lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+                lines.append('# TYPE {}_{} counter'.format(prefix, name))
+                for endpoint, stats in endpoints:
+                    lines.append('{}_{}{{endpoint="{}"}} {}'.format(
+                        prefix, name, endpoint, getattr(stats, attribute)))
+
+            name = '{}_request_duration_seconds'.format(prefix)
+            lines.append('# HELP {} Latency of requests.'.format(name))
+            lines.append('# TYPE {} histogram'.format(name))
+            for endpoint, stats in endpoints:
+                cumulative_count = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS + ('+Inf',), stats.bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                        name, endpoint, bound, cumulative_count))
+                lines.append('{}_sum{{endpoint="{}"}} {}'.format(name, endpoint, stats.latency_sum))
+                lines.append('{}_count{{endpoint="{}"}} {}'.format(name, endpoint, stats.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus_textfile(self, path):
+        """Write the metrics for the textfile collector of node_exporter. The file is replaced
+        atomically, so the collector never reads a half-written file.
+        """
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.format_prometheus())
+        os.replace(tmp_path, path)
+
+
+# The metrics shared by all the clients in this process.
+default_metrics = Metrics()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parsers of BDWM pages.
+"""
+import datetime
+import html
+import re
+from typing import FrozenSet, List, Optional, Tuple
+
+from utils import get_raw_string_from_content
+
+_LIST_TIME_PATTERN = re.compile(
+    r'^(?:(?:(\d{4})-)?(\d{1,2})-(\d{1,2}))?\s*(?:(\d{1,2}):(\d{2})(?::(\d{2}))?)?$')
+_BOARD_ITEM_BASE_CLASSES = {'list-item', 'list-item-topic', 'list-item-single'}
+
+_MAIL_ITEM_CLASS = 'class="list-item row-wrapper"'
+_MAIL_ITEM_PATTERN = re.compile(r'<div\s[^>]*{}[^>]*>'.format(_MAIL_ITEM_CLASS))
+_DATA_ITEMID_PATTERN = re.compile(r'\sdata-itemid="([^"]*)"')
+_MAIL_TIME_PATTERN = re.compile(r'<span\s+class="time l"\s*>([^<]*)</span>')
+_MAIL_SENDER_PATTERN = re.compile(
+    r'<div\s+class="sender l"\s*>(?:<img[^>]*>)?<span\s+class="name"\s*>([^<]*)</span>')
+_MAIL_TITLE_PATTERN = re.compile(r'<div\s+class="title l(?: unread)?"\s*>([^<]*)</div>')
+# 2020-08-06 16:05:31
+_MAIL_TIME_FORMAT_PATTERN = re.compile(r'\s*\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\s*$')
+
+_POST_TIME_PATTERN = re.compile(r'\d{4}-\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}(?::\d{2})?')
+_PAGE_NUMBER_PATTERN = re.compile(r'[?&]page=(\d+)')
+
+
+def _make_soup(page_content):
+    # BeautifulSoup takes long to import, load it only when a page is parsed with it.
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(page_content, features="html.parser")
+
+
+def _parse_datetime_with_dateutil(time_str) -> datetime.datetime:
+    # dateutil takes long to import, load it only for times in unexpected formats.
+    import dateutil.parser
+    return dateutil.parser.parse(time_str)
+
+
+def parse_list_time(time_str, now: datetime.datetime = None) -> Optional[datetime.datetime]:
+    """Parse the time shown in lists, which may omit the year ("11-30 12:00", within the last
+    year) or the date ("12:00", for today). Return None if time_str isn't a time.
+    """
+    match = _LIST_TIME_PATTERN.match(time_str.strip())
+    if not match or not any(match.groups()):
+        return None
+    year, month, day, hour, minute, second = match.groups()
+    now = now or datetime.datetime.now()
+    # Around New Year, "12-31 23:00" is in the last year, so is "02-29" in a year after a leap
+    # year.
+    years = [int(year)] if year else [now.year, now.year - 1] if month else [now.year]
+    for candidate_year in years:
+        try:
+            time = datetime.datetime(
+                candidate_year,
+                int(month) if month else now.month,
+                int(day) if day else now.day,
+                int(hour or 0), int(minute or 0), int(second or 0))
+        except ValueError:
+            continue
+        if year or not month or time <= now or candidate_year < now.year:
+            return time
+    return None
+
+
+class BoardThread:
+    """A thread (in topic mode) or a post (in single mode) in the list of a board page."""
+    __slots__ = ('itemid', 'num', 'title', 'author', 'time', 'reply_count', 'flags')
+
+    def __init__(self, itemid: int, num: Optional[int], title, author,
+                 time: Optional[datetime.datetime], reply_count: int, flags: FrozenSet[str]):
+        # threadid in topic mode, postid in single mode.
+        self.itemid = itemid
+        # The number of the post inside the board, None for pinned items.
+        self.num = num
+        self.title = title
+        self.author = author
+        self.time = time
+        self.reply_count = reply_count
+        # Like "top", "mark", "digest" and "highlight".
+        self.flags = flags
+
+    @property
+    def is_top(self):
+        return 'top' in self.flags
+
+    def to_dict(self) -> dict:
+        return {
+            'itemid': self.itemid,
+            'num': self.num,
+            'title': self.title,
+            'author': self.author,
+            'time': self.time.isoformat(sep=' ') if self.time else None,
+            'reply_count': self.reply_count,
+            'flags': sorted(self.flags),
+        }
+
+    def __repr__(self):
+        return 'BoardThread({!r})'.format(self.to_dict())
+
+
+def _get_text(element, name, class_name):
+    child = element.find(name, class_=class_name)
+    return child.get_text(strip=True) if child else ''
+
+
+def parse_board_threads(page_content) -> List[BoardThread]:
+    soup = _make_soup(page_content)
+    now = datetime.datetime.now()
+    threads = []
+    for item in soup.find_all('div', class_='list-item', attrs={'data-itemid': True}):
+        flags = set(item['class']) - _BOARD_ITEM_BASE_CLASSES
+        icons = item.find('div', class_='icons')
+        if icons:
+            flags.update(icon['class'][0] for icon in icons.find_all('span', class_=True))
+        num = _get_text(item, 'div', 'id')
+        reply_count = _get_text(item, 'div', 'reply-num')
+        threads.append(BoardThread(
+            itemid=int(item['data-itemid']),
+            num=int(num) if num.isdigit() else None,
+            title=_get_text(item, 'div', 'title'),
+            author=_get_text(item, 'div', 'name'),
+            time=parse_list_time(_get_text(item, 'div', 'time'), now),
+            reply_count=int(reply_count) if reply_count.isdigit() else 0,
+            flags=frozenset(flags),
+        ))
+    return threads
+
+
+class ThreadPost:
+    """A post on the pages of a thread, its content is text with ANSI font codes."""
+    __slots__ = ('postid', 'floor', 'author', 'time', 'content')
+
+    def __init__(self, postid: int, floor: Optional[int], author,
+                 time: Optional[datetime.datetime], content):
+        self.postid = postid
+        self.floor = floor
+        self.author = author
+        self.time = time
+        self.content = content
+
+    def to_dict(self) -> dict:
+        return {
+            'postid': self.postid,
+            'floor': self.floor,
+            'author': self.author,
+            'time': self.time.isoformat(sep=' ') if self.time else None,
+            'content': self.content,
+        }
+
+    def __repr__(self):
+        return 'ThreadPost({!r})'.format(self.to_dict())
+
+
+def _get_post_content(post_card) -> str:
+    content = post_card.find('div', class_='file-read')
+    if content is None:
+        return ''
+    # The json content the post is rendered from keeps the fonts, the html may not.
+    if content.get('data-content'):
+        try:
+            return get_raw_string_from_content(content['data-content'])
+        except (ValueError, TypeError, AttributeError):
+            pass
+    return '\n'.join(line.get_text() for line in content.find_all('p')) or content.get_text()
+
+
+def _get_page_count(soup) -> int:
+    paging = soup.find('div', class_='paging')
+    if paging is None:
+        return 1
+    pages = [int(page) for page in _PAGE_NUMBER_PATTERN.findall(
+        ' '.join(link.get('href', '') for link in paging.find_all('a')))]
+    pages += [int(link['data-page']) for link in paging.find_all(attrs={'data-page': True})
+              if link['data-page'].isdigit()]
+    return max(pages + [1])
+
+
+def parse_thread_page(page_content) -> Tuple[List[ThreadPost], int]:
+    """Parse a page of a thread, return its posts and the number of pages of the thread."""
+    soup = _make_soup(page_content)
+    posts = []
+    for post_card in soup.find_all('div', class_='post-card', attrs={'data-postid': True}):
+        floor = _get_text(post_card, 'span', 'floor').lstrip('#')
+        post_time = _POST_TIME_PATTERN.search(_get_text(post_card, 'span', 'post-time'))
+        posts.append(ThreadPost(
+            postid=int(post_card['data-postid']),
+            floor=int(floor) if floor.isdigit() else None,
+            author=_get_text(post_card, 'p', 'username'),
+            time=parse_list_time(post_time.group()) if post_time else None,
+            content=_get_post_content(post_card),
+        ))
+    return posts, _get_page_count(soup)
+
+
+def parse_mail_time(mail_time_str) -> datetime.datetime:
+    """Parse mail time like "2020-08-06 16:05:31", falling back to dateutil for other formats."""
+    if not _MAIL_TIME_FORMAT_PATTERN.match(mail_time_str):
+        return _parse_datetime_with_dateutil(mail_time_str)
+    s = mail_time_str.strip()
+    return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                             int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+
+class MailItem:
+    """A mail in the mail list."""
+    __slots__ = ('postid', 'time', 'sender', 'title')
+
+    def __init__(self, postid: str, time: datetime.datetime, sender, title):
+        self.postid = postid
+        self.time = time
+        self.sender = sender
+        self.title = title
+
+    def __repr__(self):
+        return 'MailItem({!r}, {!r}, {!r}, {!r})'.format(
+            self.postid, self.time, self.sender, self.title)
+
+
+def _get_mail_items_fast(page_content) -> Optional[List[Tuple[str, datetime.datetime, str, str]]]:
+    """Scan the mail items with regular expressions instead of building a whole html tree.
+    Return None if the page doesn't look as expected, then the slow parser should be used.
+    """
+    items = list(_MAIL_ITEM_PATTERN.finditer(page_content))
+    if len(items) != page_content.count(_MAIL_ITEM_CLASS):
+        return None
+    mails = []
+    for i, item in enumerate(items):
+        itemid = _DATA_ITEMID_PATTERN.search(item.group())
+        if not itemid:
+            continue
+        item_end = items[i + 1].start() if i + 1 < len(items) else len(page_content)
+        mail_time = _MAIL_TIME_PATTERN.search(page_content, item.end(), item_end)
+        sender = _MAIL_SENDER_PATTERN.search(page_content, item.end(), item_end)
+        title = _MAIL_TITLE_PATTERN.search(page_content, item.end(), item_end)
+        if not mail_time or not sender or not title:
+            return None
+        mails.append((itemid.group(1), parse_mail_time(mail_time.group(1)),
+                      html.unescape(sender.group(1)).strip(),
+                      html.unescape(title.group(1)).strip()))
+    return mails
+
+
+def _get_mail_items_with_soup(page_content) -> List[Tuple[str, datetime.datetime, str, str]]:
+    soup = _make_soup(page_content)
+
+    mails = []
+    for mail in soup.find_all('div', attrs={'class': 'list-item row-wrapper'}):
+        if 'data-itemid' not in mail.attrs:
+            continue
+        mail_time_str = mail.find('span', attrs={'class': 'time l'}).text
+        # 2020-08-06 16:05:31
+        mail_datetime = _parse_datetime_with_dateutil(mail_time_str)
+        sender = mail.find('div', class_='sender')
+        sender_name = sender.find('span', class_='name') if sender else None
+        mails.append((mail.attrs['data-itemid'], mail_datetime,
+                      sender_name.get_text(strip=True) if sender_name else '',
+                      _get_text(mail, 'div', 'title')))
+    return mails
+
+
+def get_mail_items(page_content) -> List[MailItem]:
+    mails = _get_mail_items_fast(page_content)
+    if mails is None:
+        mails = _get_mail_items_with_soup(page_content)
+    return [MailItem(*mail) for mail in mails]
+
+
+def get_mail_postid_and_time(page_content) -> List[Tuple[str, datetime.datetime]]:
+    return [(mail.postid, mail.time) for mail in get_mail_items(page_content)]
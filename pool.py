@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A pool of BDWM clients logged in with different accounts, so that jobs on many boards are
+spread over the accounts and their request streams run in parallel.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import os
+import threading
+from typing import Callable, Iterable, List
+
+from BDWM import BDWM
+from board_registry import get_board_registry
+from utils import read_file, bold_red
+
+ALL_BOARDS = '*'
+
+
+class _Account:
+    def __init__(self, id, password, boards, max_workers):
+        self.id = id
+        self.password = password
+        self.boards = {board.lower() for board in boards}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='BDWMPool-{}'.format(id))
+        self.client = None
+        self.client_lock = threading.Lock()
+        # The number of calls submitted to the account and not finished yet.
+        self.load = 0
+
+
+class BDWMPool:
+    """Route every call to the least loaded account allowed to operate on its board.
+
+    An account is allowed on a board if the board is in its "boards" ("*" means every board),
+    or if the account is one of the "bms" of the board in board.json. Every account has its own
+    session and rate limits, so the throughput grows with the number of accounts. Clients are
+    created with client_factory(id, password) on their first call.
+    """
+
+    def __init__(self, accounts: List[dict], max_workers_per_account: int = 4,
+                 client_factory: Callable[..., BDWM] = BDWM, board_config='board.json'):
+        assert accounts, 'At least one account is needed!'
+        self._accounts = [
+            _Account(account['id'], account['password'], account.get('boards', []),
+                     max_workers_per_account)
+            for account in accounts]
+        self._client_factory = client_factory
+        self._board_config = board_config
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, path, **kwargs) -> 'BDWMPool':
+        """Load the accounts from a JSON file like
+        [{"id": "PES", "password_file": "pes.txt", "boards": ["Test"]}, ...]
+        where password_file is relative to the JSON file.
+        """
+        with open(path) as f:
+            accounts = json.load(f)
+        config_dir = os.path.dirname(os.path.abspath(path))
+        for account in accounts:
+            if 'password' not in account:
+                password_file = os.path.join(
+                    config_dir, os.path.expanduser(account['password_file']))
+                account['password'] = read_file(password_file).strip('\n')
+        return cls(accounts, **kwargs)
+
+    @property
+    def ids(self) -> List[str]:
+        return [account.id for account in self._accounts]
+
+    def _get_bms(self, board_name) -> set:
+        board_info = get_board_registry(self._board_config).get(board_name) or {}
+        return {bm.lower() for bm in board_info.get('bms', [])}
+
+    def _get_eligible_accounts(self, board_name) -> List[_Account]:
+        bms = self._get_bms(board_name)
+        accounts = [
+            account for account in self._accounts
+            if ALL_BOARDS in account.boards or board_name.lower() in account.boards
+            or account.id.lower() in bms]
+        if not accounts:
+            raise ValueError(bold_red('没有账号可以操作{}版'.format(board_name)))
+        return accounts
+
+    def get_accounts_for_board(self, board_name) -> List[str]:
+        return [account.id for account in self._get_eligible_accounts(board_name)]
+
+    def _get_client(self, account: _Account) -> BDWM:
+        # Login on the first call, the other calls of the account wait for it.
+        with account.client_lock:
+            if account.client is None:
+                account.client = self._client_factory(account.id, account.password)
+            return account.client
+
+    def _acquire_account(self, board_name) -> _Account:
+        accounts = self._get_eligible_accounts(board_name)
+        with self._lock:
+            account = min(accounts, key=lambda account: account.load)
+            account.load += 1
+        return account
+
+    def _release_account(self, account: _Account):
+        with self._lock:
+            account.load -= 1
+
+    def submit(self, board_name, func: Callable, *args, **kwargs) -> Future:
+        """Run func(client, *args, **kwargs) with the least loaded account allowed on
+        board_name. func can be a BDWM method, like pool.submit(board, BDWM.operate_post,
+        board, postids, 'mark').
+        """
+        return self._submit(self._acquire_account(board_name), func, *args, **kwargs)
+
+    def _submit(self, account: _Account, func: Callable, *args, **kwargs) -> Future:
+        def run():
+            try:
+                return func(self._get_client(account), *args, **kwargs)
+            finally:
+                self._release_account(account)
+
+        try:
+            return account.executor.submit(run)
+        except BaseException:
+            self._release_account(account)
+            raise
+
+    def _get_account(self, account_id) -> _Account:
+        for account in self._accounts:
+            if account.id.lower() == account_id.lower():
+                return account
+        raise ValueError(bold_red('账号池中没有这个账号：{}'.format(account_id)))
+
+    def submit_to(self, account_id, func: Callable, *args, **kwargs) -> Future:
+        """Like submit, but always run with the given account, for calls depending on whose
+        account it is, like reading its mailbox or editing its own posts.
+        """
+        account = self._get_account(account_id)
+        with self._lock:
+            account.load += 1
+        return self._submit(account, func, *args, **kwargs)
+
+    def run(self, calls: Iterable[tuple]) -> List:
+        """Run the calls in parallel and return their results in order. Every call is a tuple
+        of (board_name, func, *args) as the arguments of submit.
+        """
+        futures = [self.submit(*call) for call in calls]
+        return [future.result() for future in futures]
+
+    def for_board(self, board_name) -> BDWM:
+        """Get the client of the least loaded account allowed on board_name, for calls made
+        outside the pool.
+        """
+        accounts = self._get_eligible_accounts(board_name)
+        with self._lock:
+            account = min(accounts, key=lambda account: account.load)
+        return self._get_client(account)
+
+    def close(self):
+        for account in self._accounts:
+            account.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
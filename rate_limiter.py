@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Client-side pacing and retrying of requests to BDWM.
+"""
+import random
+import threading
+import time
+
+import requests
+
+# Endpoint classes, each of them is paced by its own token bucket.
+READ = 'read'
+POST = 'post'
+MODERATE = 'moderate'
+
+# Status codes meaning the server is busy or throttling us, the request may work later.
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+_THROTTLE_STATUS_CODES = {429, 503}
+
+
+class TransientError(requests.HTTPError):
+    """The server is busy or throttling us, the request may work later."""
+
+    def __init__(self, response: requests.Response):
+        super().__init__('HTTP {} from {}'.format(response.status_code, response.url),
+                         response=response)
+
+
+class TokenBucket:
+    """Allow rate requests per second with bursts of up to burst requests.
+    The rate is halved when the server throttles us, and recovers slowly after successes.
+    """
+
+    def __init__(self, rate: float, burst: int, min_rate: float = None):
+        self._max_rate = rate
+        self._min_rate = min_rate or rate / 16
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def acquire(self):
+        """Take a token, waiting until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            # Take the token in advance, so that waiting threads line up behind each other.
+            self._tokens -= 1
+            wait_time = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def throttle(self):
+        with self._lock:
+            self._rate = max(self._min_rate, self._rate / 2)
+
+    def recover(self):
+        with self._lock:
+            self._rate = min(self._max_rate, self._rate + self._max_rate / 20)
+
+
+class RequestScheduler:
+    """All the requests of a client go through the scheduler, which paces them with a token
+    bucket per endpoint class, and retries idempotent ones on transient failures with
+    jittered exponential backoff.
+    """
+    # {endpoint class: (requests per second, burst)}
+    DEFAULT_LIMITS = {
+        READ: (10, 10),
+        POST: (2, 2),
+        MODERATE: (2, 4),
+    }
+
+    def __init__(self, limits: dict = None, max_retries=4, base_delay=0.5, max_delay=30.0):
+        limits = dict(self.DEFAULT_LIMITS, **(limits or {}))
+        self._buckets = {
+            endpoint_class: TokenBucket(rate, burst)
+            for endpoint_class, (rate, burst) in limits.items()
+        }
+        self._max_retries = max_retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    def _get_retry_delay(self, attempt, error):
+        delay = random.uniform(0, min(self._max_delay, self._base_delay * 2 ** attempt))
+        if isinstance(error, TransientError):
+            retry_after = error.response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = max(delay, min(self._max_delay, int(retry_after)))
+        return delay
+
+    def run(self, endpoint_class, send, idempotent: bool, on_retry=None):
+        """Call send() when the bucket of endpoint_class allows, and return its result.
+        send() should raise TransientError or a requests connection error on transient
+        failures, which are retried only if idempotent is True. on_retry(error) is called
+        before every retry.
+        """
+        bucket = self._buckets[endpoint_class]
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                result = send()
+            except (TransientError, requests.ConnectionError, requests.Timeout) as e:
+                if isinstance(e, TransientError) and \
+                        e.response.status_code in _THROTTLE_STATUS_CODES:
+                    bucket.throttle()
+                if not idempotent or attempt >= self._max_retries:
+                    raise
+                if on_retry:
+                    on_retry(e)
+                time.sleep(self._get_retry_delay(attempt, e))
+                attempt += 1
+                continue
+            bucket.recover()
+            return result
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk store of BDWM login sessions, so that a new client can skip the login round-trip.
+"""
+import os
+from typing import Optional, Tuple
+
+from utils import get_cache_path, load_json_file, dump_json_file
+
+
+class SessionStore:
+    """Keep the skey/uid cookie of every user id in its own file, readable only by the owner."""
+
+    def __init__(self, directory=None):
+        self._directory = directory or os.path.dirname(get_cache_path('sessions', ''))
+        os.makedirs(self._directory, mode=0o700, exist_ok=True)
+
+    def _get_path(self, id):
+        # Ids on BDWM only contain letters and digits, but never trust them as a file name.
+        file_name = ''.join(c if c.isalnum() or c in '_-' else '_' for c in id)
+        return os.path.join(self._directory, '{}.json'.format(file_name))
+
+    def load(self, id) -> Optional[Tuple[str, str]]:
+        session = load_json_file(self._get_path(id))
+        if not session or 'skey' not in session or 'uid' not in session:
+            return None
+        return session['skey'], session['uid']
+
+    def save(self, id, skey, uid):
+        dump_json_file(self._get_path(id), {'skey': skey, 'uid': uid}, mode=0o600)
+
+    def delete(self, id):
+        try:
+            os.remove(self._get_path(id))
+        except FileNotFoundError:
+            pass
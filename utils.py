@@ -5,53 +5,114 @@ Created on Mon Mar 23 21:37:13 2020
 
 @author: KakaHiguain@BDWM
 """
-import datetime
-from typing import List, Tuple
-
-from bs4 import BeautifulSoup
-import dateutil.parser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+from json.encoder import encode_basestring as _encode_json_string
+import os
+import re
+from typing import List
 
 
 SEPARATE_BAR = "======================"
+CACHE_DIR_NAME = 'pku-bbs'
+
+# "ESC[" followed by optional font codes like "1;31m".
+_ANSI_SEQUENCE_PATTERN = re.compile(r'\x1b\[(?:([0-9;]*)m)?')
+
+
+# Font of an ansi segment: (bold, underline, fore_color, back_color).
+_DEFAULT_ANSI_FONT = (False, False, 9, 9)
+
+
+@functools.lru_cache(maxsize=4096)
+def _apply_ansi_font_codes(font, font_codes):
+    """Get the font after applying font codes like "1;31", and the json prefix of a segment
+    in that font. There are only a few distinct fonts and codes in a post, so it's cached.
+    """
+    bold, underline, fore_color, back_color = font
+    for code in font_codes.split(';'):
+        code = int(code) if code else 0
+        if 30 <= code < 40:
+            fore_color = code - 30 if code <= 37 else 9
+        elif 40 <= code < 50:
+            back_color = code - 40 if code <= 47 else 9
+        elif code == 1:
+            bold = True
+        elif code == 4:
+            underline = True
+        elif code == 0:
+            bold, underline, fore_color, back_color = _DEFAULT_ANSI_FONT
+    font = (bold, underline, fore_color, back_color)
+    return font, _get_ansi_segment_prefix(font)
+
+
+def _get_ansi_segment_prefix(font):
+    bold, underline, fore_color, back_color = font
+    return '{{"type":"ansi","bold":{},"underline":{},"fore_color":{},"back_color":{},' \
+           '"content":'.format(str(bold).lower(), str(underline).lower(), fore_color, back_color)
 
 
 def get_content_from_raw_string(content_string):
-    parts = content_string.split('\u001B[')
-    change_font = content_string.startswith('\u001B[')
-    template = '{{"type":"ansi","bold":{},"underline":{},"fore_color":{},' \
-               '"back_color":{},"content":"{}"}}'
-    bold, underline, fore_color, back_color = 'false', 'false', 9, 9
-    res = []
-    for part in parts:
-        pos = part.find('m')
-        # The first part may not change font.
-        if not change_font:
-            pos = -1
-            change_font = True
-        if pos > -1:
-            font_codes = part[:pos].split(';')
-            if len(font_codes) == 1 and font_codes[0] == '':
-                font_codes[0] = '0'
-            for code in font_codes:
-                code = int(code)
-                if code in range(30, 40):
-                    fore_color = code - 30 if code <= 37 else 9
-                elif code in range(40, 50):
-                    back_color = code - 40 if code <= 47 else 9
-                elif code == 1:
-                    bold = 'true'
-                elif code == 4:
-                    underline = 'true'
-                elif code == 0:
-                    bold, underline, fore_color, back_color = 'false', 'false', 9, 9
-                else:
-                    pass
-        content = part[pos + 1:].replace("\\", '\\\\') \
-                                .replace('\"', '\\\"') \
-                                .replace('\n', '\\n')
-        res.append(template.format(bold, underline, fore_color, back_color, content))
-
-    return '[{}]'.format(','.join(res)).replace('\x1b', '')
+    """Convert text with ANSI font codes to the json content of BDWM in one pass.
+    Every "ESC[" starts a new segment, and the font codes in "ESC[...m" apply from there.
+    """
+    # [text, font codes, text, font codes, ..., text], font codes is None for a bare "ESC[".
+    parts = _ANSI_SEQUENCE_PATTERN.split(content_string)
+    # Stray ESC characters are dropped from the content.
+    has_stray_escape = content_string.count('\x1b') > len(parts) // 2
+    font = _DEFAULT_ANSI_FONT
+    prefix = _get_ansi_segment_prefix(font)
+    segments = []
+    for i in range(0, len(parts), 2):
+        if i:
+            font_codes = parts[i - 1]
+            if font_codes is not None:
+                font, prefix = _apply_ansi_font_codes(font, font_codes)
+        content = parts[i].replace('\x1b', '') if has_stray_escape else parts[i]
+        segments.append(prefix + _encode_json_string(content) + '}')
+    return '[{}]'.format(','.join(segments))
+
+
+def _get_ansi_codes_between_fonts(previous_font, font) -> str:
+    """Get the font codes changing previous_font to font, starting over with "0" only when bold
+    or underline is turned off, as there are no codes for that.
+    """
+    bold, underline, fore_color, back_color = font
+    codes = []
+    if (previous_font[0] and not bold) or (previous_font[1] and not underline):
+        codes.append('0')
+        previous_font = _DEFAULT_ANSI_FONT
+    if bold and not previous_font[0]:
+        codes.append('1')
+    if underline and not previous_font[1]:
+        codes.append('4')
+    if fore_color != previous_font[2]:
+        codes.append(str(30 + fore_color))
+    if back_color != previous_font[3]:
+        codes.append(str(40 + back_color))
+    return ';'.join(codes)
+
+
+def get_raw_string_from_content(content) -> str:
+    """Convert the json content of BDWM (a string or the parsed list) back to text with ANSI
+    font codes, the reverse of get_content_from_raw_string. Segments other than ansi ones
+    keep only their text.
+    """
+    if isinstance(content, str):
+        content = json.loads(content)
+    font = _DEFAULT_ANSI_FONT
+    parts = []
+    for segment in content:
+        if segment.get('type') == 'ansi':
+            new_font = (bool(segment.get('bold')), bool(segment.get('underline')),
+                        int(segment.get('fore_color', 9)), int(segment.get('back_color', 9)))
+            if new_font != font:
+                parts.append('\x1b[{}m'.format(_get_ansi_codes_between_fonts(font, new_font)))
+                font = new_font
+        parts.append(segment.get('content') or '')
+    return ''.join(parts)
 
 
 def yes_or_no_prompt(prompt_string, func, **argv):
@@ -91,7 +152,62 @@ def read_file(path):
         return f.read()
 
 
-def get_postid_list_from_internal_postids(bdwm, board, internal_postids) -> List[str]:
+def get_cache_path(*parts):
+    """Get a path inside the local cache directory, creating its parent directories."""
+    cache_root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(cache_root, CACHE_DIR_NAME, *parts)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    return path
+
+
+def load_json_file(path, default=None):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def dump_json_file(path, data, mode=0o644):
+    """Write data to path atomically, so that readers never see a half-written file."""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def iter_with_prefetch(fetch, first_page=1, prefetch=2, last_page=None):
+    """Yield fetch(page) for page from first_page to last_page (endless if None), while the
+    next prefetch pages are fetched in background threads.
+    """
+    with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as executor:
+        futures = deque()
+        next_page = first_page
+        try:
+            while True:
+                while len(futures) <= prefetch and (last_page is None or next_page <= last_page):
+                    futures.append(executor.submit(fetch, next_page))
+                    next_page += 1
+                if not futures:
+                    return
+                yield futures.popleft().result()
+        finally:
+            # The caller may stop early, don't wait for the pages it will never use.
+            for future in futures:
+                future.cancel()
+
+
+def get_mail_postid_and_time(page_content):
+    """Get the (postid, time) of the mails on a mail list page, kept here for scripts written
+    before it moved to parsers, which is imported only when used as it loads bs4.
+    """
+    from parsers import get_mail_postid_and_time as parse_mail_postid_and_time
+    return parse_mail_postid_and_time(page_content)
+
+
+def parse_internal_postids(internal_postids) -> List[int]:
+    """Parse internal postids like "11233,12345~12349" into a list of numbers."""
     parts = internal_postids.split(',')
     internal_postid_list = []
     for part in parts:
@@ -103,25 +219,35 @@ def get_postid_list_from_internal_postids(bdwm, board, internal_postids) -> List
             if left_bound > right_bound:
                 raise ValueError('Invalid interval: {}!'.format(part))
             internal_postid_list.extend(range(left_bound, right_bound + 1))
-
-    postid_list = []
-    for internal_postid in internal_postid_list:
+    return internal_postid_list
+
+
+def get_postid_list_from_internal_postids(
+        bdwm, board, internal_postids, cache=None, max_workers=8) -> List[int]:
+    """Resolve internal postids to postids, fetching at most max_workers posts at a time.
+    Numbers found in cache (see cache.PostNumCache) are not fetched again.
+    """
+    internal_postid_list = parse_internal_postids(internal_postids)
+    postids = {}
+    if cache is not None:
+        for internal_postid in internal_postid_list:
+            postid = cache.get(internal_postid)
+            if postid is not None:
+                postids[internal_postid] = postid
+    missing = sorted(set(internal_postid_list) - set(postids))
+
+    def fetch(internal_postid):
         post_info = bdwm.get_post_by_num(board, internal_postid)
-        postid_list.append(post_info['list'][0]['postid'])
-
-    return postid_list
-
-
-def get_mail_postid_and_time(page_content) -> List[Tuple[int, datetime.datetime]]:
-    soup = BeautifulSoup(page_content, features="html.parser")
-
-    mails = soup.find_all('div', attrs={'class': 'list-item row-wrapper'})
-    postids = []
-    for mail in mails:
-        if 'data-itemid' not in mail.attrs:
-            continue
-        mail_time_str = mail.find('span', attrs={'class': 'time l'}).text
-        # 2020-08-06 16:05:31
-        mail_datetime = dateutil.parser.parse(mail_time_str)
-        postids.append((mail.attrs['data-itemid'], mail_datetime))
-    return postids
+        return internal_postid, post_info['list'][0]['postid']
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for internal_postid, postid in executor.map(fetch, missing):
+                postids[internal_postid] = postid
+                if cache is not None:
+                    cache.put(internal_postid, postid)
+    finally:
+        if cache is not None:
+            cache.save()
+
+    return [postids[internal_postid] for internal_postid in internal_postid_list]